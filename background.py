@@ -0,0 +1,62 @@
+""" Background models which update one preallocated accumulator in place, the
+uint8 background is only refreshed when it is read
+"""
+import cv2
+import numpy as np
+
+
+class Background:
+    def __init__(self):
+        self._background = None
+        self._uint8 = None
+        self.stale = True
+        self.frames = 0
+
+    def process_frame(self, frame):
+        if self._background is None:
+            self.init(frame)
+        else:
+            self.update(frame)
+        self.frames += 1
+        self.stale = True
+
+    def init(self, frame):
+        self._background = frame.copy()
+
+    def update(self, frame):
+        raise NotImplementedError
+
+    @property
+    def background(self):
+        if self._background is None:
+            return None
+        if self._background.dtype == np.uint8:
+            return self._background
+        if self.stale:
+            if self._uint8 is None:
+                self._uint8 = np.empty(self._background.shape, np.uint8)
+            np.copyto(self._uint8, self._background, casting="unsafe")
+            self.stale = False
+        return self._uint8
+
+
+class AverageBackground(Background):
+    # mean of every frame until AVERAGE_OVER frames have been seen, then an
+    # exponential average with the same weight
+    AVERAGE_OVER = 1000
+
+    def init(self, frame):
+        self._background = np.float32(frame)
+
+    def update(self, frame):
+        alpha = 1 / (min(self.frames, AverageBackground.AVERAGE_OVER - 1) + 1)
+        cv2.accumulateWeighted(frame, self._background, alpha)
+
+
+class MinBackground(Background):
+    BACKGROUND_WEIGHT_ADD = 0.001
+    STILL_FOR = 200
+
+    # update pixels which have shown no movement for 200 frames
+    def update(self, frame):
+        np.minimum(self._background, frame, out=self._background)
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+""" Micro benchmarks for the per frame hot path on synthetic frames, results are
+saved as json so runs can be compared across commits
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from background import AverageBackground, MinBackground
+from framering import FrameRing
+from logs import init_logging
+from main import FRAME_SLOTS, Recorder
+from motion import WINDOW_SIZE, Motion
+from slidingwindow import EncodedWindow, SlidingWindow
+
+SCENES = ["static", "blobs", "noise"]
+# stages slower than this ratio of the compared run are reported as regressions,
+# unless the difference is below REGRESSION_MIN_MS which is timer noise
+REGRESSION_RATIO = 1.1
+REGRESSION_MIN_MS = 0.05
+# pre-roll JPEG qualities to report memory and cpu for, 0 is raw frames
+PREVIEW_QUALITIES = [0, 95, 90, 75]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--resolution",
+        action="append",
+        help="WIDTHxHEIGHT to benchmark, may be given more than once, default 640x480",
+    )
+    parser.add_argument(
+        "--frames", type=int, default=100, help="frames to time per stage"
+    )
+    parser.add_argument("--output", help="write results as json to this file")
+    parser.add_argument("--compare", help="a previous json result to compare to")
+    parser.add_argument(
+        "--no-transport",
+        action="store_true",
+        help="skip the cross process transport benchmarks",
+    )
+    args = parser.parse_args()
+    if not args.resolution:
+        args.resolution = ["640x480"]
+    args.resolution = [tuple(map(int, r.split("x"))) for r in args.resolution]
+    return args
+
+
+def synthetic_frames(scene, resolution, count, seed=0):
+    width, height = resolution
+    rng = np.random.default_rng(seed)
+    base = rng.integers(40, 80, (height, width, 3), dtype=np.uint8)
+    frames = []
+    for i in range(count):
+        frame = base.copy()
+        if scene == "blobs":
+            # a few small warm blobs moving across the scene
+            for b in range(3):
+                x = (i * (4 + b * 3) + b * width // 3) % width
+                y = height // 4 + b * height // 4
+                cv2.circle(frame, (x, y), max(2, width // 40), (220, 220, 220), -1)
+        elif scene == "noise":
+            frame = cv2.add(
+                frame, rng.integers(0, 30, frame.shape, dtype=np.uint8), dtype=-1
+            )
+        frames.append(frame)
+    return frames
+
+
+def summarise(times):
+    times = np.array(times) * 1000
+    return {
+        "mean_ms": float(times.mean()),
+        "median_ms": float(np.median(times)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "max_ms": float(times.max()),
+        "count": len(times),
+    }
+
+
+def time_each(fn, items):
+    times = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        times.append(time.perf_counter() - start)
+    return summarise(times)
+
+
+def bench_motion_stages(frames):
+    results = {}
+    results["cvtColor"] = time_each(
+        lambda f: cv2.cvtColor(f, cv2.COLOR_BGR2GRAY), frames
+    )
+    grey = [cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) for f in frames]
+    motion = Motion()
+    gap = motion.config.frame_compare_gap
+    delta_thresh = motion.delta_thresh
+    pairs = [(grey[i - gap], grey[i]) for i in range(len(grey))]
+    results["absdiff"] = time_each(lambda p: cv2.absdiff(*p), pairs)
+    deltas = [cv2.absdiff(*p) for p in pairs]
+    results["threshold"] = time_each(
+        lambda d: cv2.threshold(d, delta_thresh, 255, cv2.THRESH_BINARY), deltas
+    )
+    thresholds = [
+        cv2.threshold(d, delta_thresh, 255, cv2.THRESH_BINARY)[1] for d in deltas
+    ]
+    results["erode"] = time_each(
+        lambda t: cv2.erode(t, motion.kernel_trigger), thresholds
+    )
+    eroded = [cv2.erode(t, motion.kernel_trigger) for t in thresholds]
+    results["countNonZero"] = time_each(cv2.countNonZero, eroded)
+    results["mask_count"] = time_each(lambda e: len(e[e > 0]), eroded)
+
+    background = AverageBackground()
+    results["average_background"] = time_each(background.process_frame, grey)
+    background = MinBackground()
+    results["min_background"] = time_each(background.process_frame, grey)
+
+    results["process_frame"] = time_each(Motion().process_frame, frames)
+    results["process_frame_scale_2"] = time_each(Motion(scale=2).process_frame, frames)
+    return results
+
+
+def bench_sliding_window(frames):
+    window = SlidingWindow(WINDOW_SIZE)
+    results = {"add": time_each(window.add, frames)}
+    results["get_frames"] = time_each(
+        lambda _: sum(1 for f in window.get_frames()), range(len(frames))
+    )
+    return results
+
+
+def bench_preview(frames):
+    # the memory a full pre-roll takes against the cost of storing it
+    # compressed, per frame on add and to decode the whole pre-roll on a trigger
+    results = {}
+    for quality in PREVIEW_QUALITIES:
+        if quality:
+            window = EncodedWindow(WINDOW_SIZE, quality)
+        else:
+            window = SlidingWindow(WINDOW_SIZE)
+        result = {"add": time_each(window.add, frames)}
+        start = time.perf_counter()
+        sum(1 for f in window.get_frames())
+        result["decode_ms"] = (time.perf_counter() - start) * 1000
+        result["memory_mb"] = window.nbytes / 1024 / 1024
+        results[f"quality_{quality}" if quality else "raw"] = result
+    return results
+
+
+class NullEncoder:
+    def open(self, filename, size, is_color=True):
+        pass
+
+    def write(self, frame, block=None):
+        return True
+
+    def write_encoded(self, data, block=True):
+        return True
+
+    def close(self, filename, out_file=None, info=None):
+        pass
+
+    def stop(self):
+        pass
+
+
+def bench_recorder(frames):
+    height, width = frames[0].shape[:2]
+    with tempfile.TemporaryDirectory() as tmp:
+        r = Recorder(width, height, video_dir=tmp, tmp_dir=tmp, still_dir=tmp)
+        r.encoder.stop()
+        r.encoder = NullEncoder()
+        result = time_each(r.process_frame, frames)
+        r.close()
+    return {"process_frame": result}
+
+
+def consume(transport, count, latencies):
+    # sends back the time from just before each frame was put until it arrived
+    for _ in range(count):
+        item = transport.get()
+        now = time.monotonic()
+        if isinstance(transport, FrameRing):
+            latencies.put(now - transport.frame_time)
+        else:
+            latencies.put(now - item[1])
+    if isinstance(transport, FrameRing):
+        transport.close()
+
+
+def time_transport(transport, frames, warmup):
+    # one frame is in flight at a time so the latency is not queueing, the
+    # first warmup frames touch every ring slot and pipe buffer and are not
+    # counted
+    items = [frames[i % len(frames)] for i in range(warmup)] + frames
+    latencies = multiprocessing.Queue()
+    p = multiprocessing.Process(target=consume, args=(transport, len(items), latencies))
+    p.start()
+    times = []
+    for frame in items:
+        start = time.monotonic()
+        if isinstance(transport, FrameRing):
+            transport.put(frame, start, block=True)
+        else:
+            transport.put((frame, start))
+        times.append(latencies.get())
+    p.join()
+    return summarise(times[warmup:])
+
+
+def bench_transport(frames):
+    # put to consumer latency per frame, with the ring sized as in production
+    results = {"queue": time_transport(multiprocessing.Queue(), frames, FRAME_SLOTS)}
+    ring = FrameRing(frames[0].shape, slots=FRAME_SLOTS)
+    results["frame_ring"] = time_transport(ring, frames, FRAME_SLOTS)
+    ring.unlink()
+    return results
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__) or "."
+            )
+            .decode()
+            .strip()
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict) and "mean_ms" not in value:
+            yield from flatten(value, f"{prefix}{key}/")
+        elif isinstance(value, dict):
+            yield f"{prefix}{key}", value
+
+
+def compare(results, previous):
+    old = dict(flatten(previous["results"]))
+    regressions = []
+    for name, stats in flatten(results):
+        if name not in old or old[name]["median_ms"] == 0:
+            continue
+        ratio = stats["median_ms"] / old[name]["median_ms"]
+        logging.info(
+            f"{name:50} {old[name]['median_ms']:8.3f}ms -> {stats['median_ms']:8.3f}ms x{ratio:.2f}"
+        )
+        slower_ms = stats["median_ms"] - old[name]["median_ms"]
+        if ratio > REGRESSION_RATIO and slower_ms > REGRESSION_MIN_MS:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    init_logging()
+    args = parse_args()
+    results = {}
+    for resolution in args.resolution:
+        res_key = f"{resolution[0]}x{resolution[1]}"
+        results[res_key] = {}
+        for scene in SCENES:
+            frames = synthetic_frames(scene, resolution, args.frames)
+            logging.info(f"Benchmarking {res_key} {scene}")
+            results[res_key][scene] = {
+                "motion": bench_motion_stages(frames),
+                "sliding_window": bench_sliding_window(frames),
+                "preview": bench_preview(frames),
+                "recorder": bench_recorder(frames),
+            }
+        if not args.no_transport:
+            frames = synthetic_frames("static", resolution, args.frames)
+            results[res_key]["transport_latency"] = bench_transport(frames)
+
+    for name, stats in flatten(results):
+        logging.info(
+            f"{name:50} median {stats['median_ms']:8.3f}ms p95 {stats['p95_ms']:8.3f}ms"
+        )
+    for res_key, scenes in results.items():
+        for scene in SCENES:
+            for name, stats in scenes[scene]["preview"].items():
+                logging.info(
+                    f"preview {res_key} {scene} {name:10} {stats['memory_mb']:7.1f}MB"
+                    f" add {stats['add']['median_ms']:7.3f}ms"
+                    f" decode {stats['decode_ms']:8.1f}ms"
+                )
+    report = {
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "frames": args.frames,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            logging.warning(f"Regressions over x{REGRESSION_RATIO}: {regressions}")
+
+
+if __name__ == "__main__":
+    main()
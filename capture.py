@@ -0,0 +1,128 @@
+""" Captures frames on a dedicated thread, paced to monotonic deadlines. Every
+frame is grabbed but only frames that will be processed are retrieved
+"""
+
+import logging
+import threading
+import time
+
+import cv2
+
+# camera formats to ask for in luma mode, in order of preference
+LUMA_FORMATS = ["GREY", "YUYV"]
+
+
+def request_luma(cap):
+    # ask for raw frames so opencv does not convert them to BGR, returns the
+    # format the camera accepted or None if it would not change
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    for name in LUMA_FORMATS:
+        fourcc = cv2.VideoWriter_fourcc(*name)
+        if (
+            cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+            and cap.get(cv2.CAP_PROP_FOURCC) == fourcc
+        ):
+            return name
+    # frames will be converted to grey from BGR, so have opencv decode them
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+    return None
+
+
+def to_luma(frame, width, height):
+    # GREY frames are already luma, YUYV interleaves luma with chroma and when
+    # the camera ignored the request the frames are BGR
+    if frame.size == width * height:
+        return frame.reshape(height, width)
+    if frame.size == width * height * 2:
+        return frame.reshape(height, width, 2)[:, :, 0]
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+class CaptureThread:
+    # put(frame, timestamp) hands a retrieved frame on, ready() says whether
+    # there is room for another frame, if not the next frame is only grabbed.
+    # With luma set only the luma plane of each frame is put. With fps None
+    # frames are read as fast as put takes them and none are skipped, for
+    # replaying files
+    def __init__(self, cap, fps, put, ready=None, metrics=None, luma=False):
+        self.cap = cap
+        self.luma = luma
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.period = None if fps is None else 1 / fps
+        self.put = put
+        self.ready = ready
+        self.metrics = metrics
+        self.frames = 0
+        self.retrieved = 0
+        self.missed = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        # only keep the latest frame in the driver so grabs are never stale
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def run(self):
+        start = time.monotonic()
+        while self.running:
+            wait = 0
+            late = False
+            if self.period is not None:
+                deadline = start + self.frames * self.period
+                wait = deadline - time.monotonic()
+                late = wait < -self.period
+            if wait > 0:
+                time.sleep(wait)
+            elif late:
+                # behind by more than a frame, skip the missed deadlines rather
+                # than bursting to catch up and grab this one without decoding
+                missed = int(-wait / self.period)
+                self.missed += missed
+                start += missed * self.period
+
+            grab_start = time.monotonic()
+            if not self.cap.grab():
+                logging.info("no frame from video capture")
+                break
+            timestamp = time.monotonic()
+            self.frames += 1
+            if self.metrics is not None:
+                self.metrics.observe("capture_wait", max(wait, 0) * 1000)
+                self.metrics.observe("capture_grab", (timestamp - grab_start) * 1000)
+            if late or (self.ready is not None and not self.ready()):
+                continue
+
+            returned, frame = self.cap.retrieve()
+            if not returned:
+                logging.info("could not retrieve frame from video capture")
+                break
+            if self.metrics is not None:
+                self.metrics.observe(
+                    "capture_retrieve", (time.monotonic() - timestamp) * 1000
+                )
+            self.retrieved += 1
+            if self.luma:
+                frame = to_luma(frame, self.width, self.height)
+            self.put(frame, timestamp)
+        self.running = False
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "retrieved": self.retrieved,
+            "skipped": self.frames - self.retrieved,
+            "missed_deadlines": self.missed,
+        }
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+""" An on device catalogue of recordings with per clip motion metadata, so
+clips can be found by time or activity without listing the spool directory
+"""
+import argparse
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+CATALOGUE_FILE = "/var/spool/cptv/catalogue.db"
+COLUMNS = [
+    "file",
+    "start_time",
+    "end_time",
+    "frames",
+    "peak_motion",
+    "mean_motion",
+    "trigger_reason",
+    "stop_reason",
+    "size",
+    "tracks",
+    "max_speed",
+    "encode_fps",
+]
+# columns added since the first catalogue, added to older databases on open
+NEW_COLUMNS = {"tracks": "INTEGER", "max_speed": "REAL", "encode_fps": "REAL"}
+
+
+class Catalogue:
+    def __init__(self, filename=CATALOGUE_FILE):
+        self.filename = filename
+        # shared by the encoder and janitor threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS clips (
+                    file TEXT PRIMARY KEY,
+                    start_time REAL,
+                    end_time REAL,
+                    frames INTEGER,
+                    peak_motion INTEGER,
+                    mean_motion REAL,
+                    trigger_reason TEXT,
+                    stop_reason TEXT,
+                    size INTEGER
+                )"""
+            )
+            existing = {
+                row["name"] for row in self.db.execute("PRAGMA table_info(clips)")
+            }
+            for column, column_type in NEW_COLUMNS.items():
+                if column not in existing:
+                    self.db.execute(
+                        f"ALTER TABLE clips ADD COLUMN {column} {column_type}"
+                    )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS clips_start ON clips (start_time)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS clips_activity ON clips (mean_motion)"
+            )
+
+    def add(self, clip):
+        with self.lock, self.db:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO clips ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                [clip.get(column) for column in COLUMNS],
+            )
+
+    def remove(self, filename):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM clips WHERE file = ?", (filename,))
+
+    def query(
+        self, start=None, end=None, min_motion=None, most_active=False, limit=None
+    ):
+        # clips overlapping start to end (unix times), oldest first or most active first
+        sql = "SELECT * FROM clips WHERE 1"
+        params = []
+        if start is not None:
+            sql += " AND end_time >= ?"
+            params.append(start)
+        if end is not None:
+            sql += " AND start_time <= ?"
+            params.append(end)
+        if min_motion is not None:
+            sql += " AND mean_motion >= ?"
+            params.append(min_motion)
+        if most_active:
+            sql += " ORDER BY mean_motion DESC"
+        else:
+            sql += " ORDER BY start_time"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, params)]
+
+    def close(self):
+        self.db.close()
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value).timestamp()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the recording catalogue")
+    parser.add_argument("--catalogue", default=CATALOGUE_FILE)
+    parser.add_argument("--start", type=parse_time, help="ISO time to search from")
+    parser.add_argument("--end", type=parse_time, help="ISO time to search to")
+    parser.add_argument("--min-motion", type=float, help="minimum mean motion pixels")
+    parser.add_argument(
+        "--most-active", action="store_true", help="order by mean motion"
+    )
+    parser.add_argument("--limit", type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    catalogue = Catalogue(args.catalogue)
+    for clip in catalogue.query(
+        args.start, args.end, args.min_motion, args.most_active, args.limit
+    ):
+        print(json.dumps(clip))
+    catalogue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+""" Loads the ThermalConfig once and reloads it in the background only when the
+file changes, so readers get the cached config without any file I/O
+"""
+import io
+import logging
+import os
+import threading
+
+from thermalconfig import ThermalConfig
+
+
+class ConfigWatcher:
+    def __init__(self, filename=None, model=None, poll_interval=5):
+        if filename is None:
+            try:
+                filename = ThermalConfig.find_config()
+            except FileNotFoundError as e:
+                logging.warning(f"{e} Using defaults")
+        self.filename = filename
+        self.model = model
+        self.poll_interval = poll_interval
+        self.mtime = None
+        self.config = None
+        # incremented every time config changes, cheap to check every frame
+        self.version = 0
+        try:
+            self.reload()
+        except Exception:
+            # start on defaults rather than failing, the file is loaded again
+            # once it changes
+            logging.exception(f"Error loading config {self.filename}, using defaults")
+            self.config = ThermalConfig.load_from_stream(io.StringIO(""), self.model)
+            self.version += 1
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def get_mtime(self):
+        if self.filename is None:
+            return None
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        mtime = self.get_mtime()
+        if self.config is not None and mtime == self.mtime:
+            return False
+        if mtime is None:
+            config = ThermalConfig.load_from_stream(io.StringIO(""), self.model)
+        else:
+            try:
+                config = ThermalConfig.load_from_file(self.filename, self.model)
+            except Exception:
+                # the last good config is kept, this file is only tried again
+                # once it changes, as it will if it was mid write
+                self.mtime = mtime
+                raise
+        self.config = config
+        self.mtime = mtime
+        self.version += 1
+        logging.info(f"Loaded config {self.filename} version {self.version}")
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.reload()
+            except Exception:
+                logging.exception(f"Error reloading config {self.filename}")
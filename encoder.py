@@ -0,0 +1,301 @@
+""" Encodes frames on a dedicated thread so motion detection keeps running at
+frame rate while clips are opened, written and finalized
+"""
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# what to do with a frame when the encode queue is full
+BLOCK = "block"  # wait for the encoder, stalling the caller
+DROP = "drop"  # drop the frame
+DEGRADE = "degrade"  # halve the frame rate once the queue is 3/4 full, then drop
+
+# encoder backends
+OPENCV = "opencv"
+FFMPEG = "ffmpeg"
+
+
+class OpenCVWriter:
+    def __init__(self, fourcc, fps):
+        self.fourcc = fourcc
+        self.fps = fps
+        self.writer = None
+
+    def open(self, filename, size, is_color=True):
+        self.writer = cv2.VideoWriter(
+            filename, self.fourcc, self.fps, size, isColor=is_color
+        )
+        if not self.writer.isOpened():
+            raise ValueError(f"Could not open {filename} for writing")
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+        self.writer = None
+
+
+class FFmpegWriter:
+    # pipes raw frames to an ffmpeg process, options left as None use ffmpeg's
+    # defaults for the codec
+    def __init__(
+        self,
+        fps,
+        codec="libx264",
+        preset=None,
+        crf=None,
+        keyframe_interval=None,
+        threads=None,
+        ffmpeg="ffmpeg",
+    ):
+        self.fps = fps
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.keyframe_interval = keyframe_interval
+        self.threads = threads
+        self.ffmpeg = ffmpeg
+        self.process = None
+
+    def get_command(self, filename, size, is_color):
+        command = [self.ffmpeg, "-hide_banner", "-loglevel", "error", "-y"]
+        command += ["-f", "rawvideo", "-pix_fmt", "bgr24" if is_color else "gray"]
+        command += ["-s", f"{size[0]}x{size[1]}", "-r", str(self.fps), "-i", "-"]
+        command += ["-c:v", self.codec, "-pix_fmt", "yuv420p"]
+        if self.preset is not None:
+            command += ["-preset", self.preset]
+        if self.crf is not None:
+            command += ["-crf", str(self.crf)]
+        if self.keyframe_interval is not None:
+            command += ["-g", str(self.keyframe_interval)]
+        if self.threads is not None:
+            command += ["-threads", str(self.threads)]
+        command.append(filename)
+        return command
+
+    def open(self, filename, size, is_color=True):
+        self.filename = filename
+        self.process = subprocess.Popen(
+            self.get_command(filename, size, is_color), stdin=subprocess.PIPE
+        )
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg has already exited, its return code says why
+            pass
+        returncode = self.process.wait()
+        self.process = None
+        if returncode:
+            raise ValueError(f"ffmpeg failed writing {self.filename} code {returncode}")
+
+
+def make_writer(config, fourcc, fps):
+    # the backend for an EncoderConfig
+    if config.backend == OPENCV:
+        return OpenCVWriter(fourcc, fps)
+    elif config.backend == FFMPEG:
+        return FFmpegWriter(
+            fps,
+            codec=config.codec,
+            preset=config.preset,
+            crf=config.crf,
+            keyframe_interval=config.keyframe_interval,
+            threads=config.threads,
+        )
+    raise ValueError(f"Unknown encoder backend {config.backend}")
+
+
+class EncoderThread:
+    def __init__(
+        self,
+        writer,
+        max_queue=80,
+        policy=DEGRADE,
+        metrics=None,
+        on_saved=None,
+        on_failed=None,
+    ):
+        if policy not in (BLOCK, DROP, DEGRADE):
+            raise ValueError(f"Unknown encoder policy {policy}")
+        # an OpenCVWriter or FFmpegWriter
+        self.writer = writer
+        self.next_writer = None
+        self.clip_open = False
+        # the first error writing the open clip, the rest of it is dropped
+        self.clip_error = None
+        self.policy = policy
+        self.metrics = metrics
+        # called with the filename and clip info once a clip has been saved,
+        # or could not be
+        self.on_saved = on_saved
+        self.on_failed = on_failed
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.skip = False
+        self.frames = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.encode_time = 0
+        self.max_encode_time = 0
+        self.clip_frames = 0
+        self.clip_encode_time = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def open(self, filename, size, is_color=True):
+        self.queue.put(("open", filename, size, is_color))
+
+    def set_writer(self, writer):
+        # used from the next clip opened
+        self.queue.put(("writer", writer))
+
+    def write(self, frame, block=None):
+        # frames are copied as the caller's buffers are reused
+        if block is None:
+            block = self.policy == BLOCK
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        if not block and self.policy == DEGRADE:
+            if depth > self.queue.maxsize * 3 // 4:
+                self.skip = not self.skip
+                if self.skip:
+                    self.dropped += 1
+                    return False
+        try:
+            self.queue.put(("frame", frame.copy()), block=block)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def write_encoded(self, data, block=True):
+        # a JPEG encoded frame, decoded on the encoder thread
+        try:
+            self.queue.put(("encoded", data), block=block)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self, filename, out_file=None, info=None):
+        # release the writer and move the clip to out_file
+        self.queue.put(("close", filename, out_file, info))
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "avg_encode_ms": 1000 * self.encode_time / max(self.frames, 1),
+            "max_encode_ms": 1000 * self.max_encode_time,
+        }
+
+    def discard(self, filename):
+        logging.error(f"Deleting failed clip {filename}: {self.clip_error}")
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        if self.metrics is not None:
+            self.metrics.inc("clips_failed")
+
+    def failed(self, out_file, info):
+        if self.on_failed is not None:
+            self.on_failed(out_file, info)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.process(*item)
+            except Exception:
+                logging.exception(f"Error encoding {item[0]}")
+
+    def process(self, command, *args):
+        if command in ("frame", "encoded"):
+            if not self.clip_open or self.clip_error is not None:
+                return
+            frame = args[0]
+            if command == "encoded":
+                frame = cv2.imdecode(frame, cv2.IMREAD_UNCHANGED)
+            start = time.perf_counter()
+            try:
+                self.writer.write(frame)
+            except Exception as e:
+                # such as ffmpeg exiting, every later write would fail too
+                logging.exception("Error writing frame, dropping the rest of the clip")
+                self.clip_error = e
+                return
+            encode_time = time.perf_counter() - start
+            self.frames += 1
+            self.clip_frames += 1
+            self.encode_time += encode_time
+            self.clip_encode_time += encode_time
+            self.max_encode_time = max(self.max_encode_time, encode_time)
+            if self.metrics is not None:
+                self.metrics.observe("encode", encode_time * 1000)
+        elif command == "writer":
+            self.next_writer = args[0]
+        elif command == "open":
+            if self.next_writer is not None:
+                self.writer = self.next_writer
+                self.next_writer = None
+            self.clip_frames = 0
+            self.clip_encode_time = 0
+            self.clip_error = None
+            self.writer.open(*args)
+            self.clip_open = True
+        elif command == "close":
+            filename, out_file, info = args
+            if not self.clip_open:
+                # opening the clip failed, which has been logged
+                self.failed(out_file, info)
+                return
+            self.clip_open = False
+            # an ffmpeg writer finishes encoding buffered frames on release
+            start = time.perf_counter()
+            try:
+                self.writer.release()
+            except Exception as e:
+                if self.clip_error is None:
+                    self.clip_error = e
+            if self.clip_error is not None:
+                self.discard(filename)
+                self.failed(out_file, info)
+                return
+            self.clip_encode_time += time.perf_counter() - start
+            encode_fps = self.clip_frames / max(self.clip_encode_time, 1e-6)
+            size = os.path.getsize(filename)
+            logging.info(
+                f"Encoded {self.clip_frames} frames at {encode_fps:.1f} fps, "
+                f"{size} bytes"
+            )
+            if self.metrics is not None:
+                self.metrics.inc("encoded_bytes", size)
+                self.metrics.set("last_encode_fps", encode_fps)
+            if info is not None:
+                info["encode_fps"] = encode_fps
+            if out_file is not None:
+                logging.info(f"Saving file to {out_file}")
+                os.rename(filename, out_file)
+                if self.on_saved is not None:
+                    self.on_saved(out_file, info)
+            logging.info(f"Encoder stats {self.stats()}")
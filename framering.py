@@ -0,0 +1,103 @@
+""" A ring of preallocated shared memory frame slots for passing frames from
+the capture process to the recorder without pickling them through a pipe
+"""
+
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class FrameRing:
+    def __init__(self, shape, dtype=np.uint8, slots=20):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=frame_bytes * slots)
+        self.frames = np.ndarray(
+            (slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf
+        )
+        # only slot indices, headers and the "DONE" sentinel go through queues
+        self.free_slots = multiprocessing.Queue()
+        self.control = multiprocessing.Queue()
+        for i in range(slots):
+            self.free_slots.put(i)
+        self.held = None
+        # monotonic times the frame last returned by get was put and captured
+        self.put_time = None
+        self.frame_time = None
+        self.frames_put = multiprocessing.Value("L", 0)
+        self.dropped = multiprocessing.Value("L", 0)
+        self.max_occupancy = multiprocessing.Value("L", 0)
+
+    @property
+    def occupancy(self):
+        return self.slots - self.free_slots.qsize()
+
+    def has_space(self):
+        return not self.free_slots.empty()
+
+    def put(self, item, timestamp=None, block=False, timeout=None):
+        # same interface as multiprocessing.Queue.put, frames are copied into a
+        # free slot and dropped if the recorder has fallen behind. With block
+        # set put waits for a free slot instead, returning False without
+        # counting a drop if none was freed within timeout
+        if not isinstance(item, np.ndarray):
+            self.control.put(item)
+            return True
+        try:
+            slot = self.free_slots.get(block, timeout)
+        except queue.Empty:
+            if block:
+                return False
+            with self.dropped.get_lock():
+                self.dropped.value += 1
+            return False
+        np.copyto(self.frames[slot], item)
+        put_time = time.monotonic()
+        if timestamp is None:
+            timestamp = put_time
+        self.control.put((slot, put_time, timestamp))
+        with self.frames_put.get_lock():
+            self.frames_put.value += 1
+        occupancy = self.occupancy
+        if occupancy > self.max_occupancy.value:
+            self.max_occupancy.value = occupancy
+        return True
+
+    def get(self, timeout=None):
+        # frames returned are views into shared memory, they are only valid
+        # until the next call to get, raises queue.Empty after timeout
+        self.release()
+        item = self.control.get(timeout=timeout)
+        if isinstance(item, tuple):
+            self.held, self.put_time, self.frame_time = item
+            return self.frames[self.held]
+        return item
+
+    def release(self):
+        if self.held is not None:
+            self.free_slots.put(self.held)
+            self.held = None
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "occupancy": self.occupancy,
+            "max_occupancy": self.max_occupancy.value,
+            "frames": self.frames_put.value,
+            "dropped": self.dropped.value,
+        }
+
+    def close(self):
+        self.release()
+        # views must be released before the shared memory can be closed
+        self.frames = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
@@ -0,0 +1,167 @@
+""" Keeps the spool directory under its disk budget from a background thread.
+Usage is tracked incrementally as recordings are saved, disk usage is only
+re-read from the filesystem on a slow timer to correct any drift
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+import psutil
+
+# what to do when the disk is over budget
+EVICT = "evict"  # delete the oldest recordings
+STOP = "stop"  # stop making new recordings
+
+
+class SpoolJanitor:
+    def __init__(
+        self,
+        spool_dir,
+        max_usage_percent,
+        exts,
+        policy=EVICT,
+        check_interval=10,
+        resync_interval=15 * 60,
+        catalogue=None,
+        sidecar_exts=(),
+    ):
+        if policy not in (EVICT, STOP):
+            raise ValueError(f"Unknown janitor policy {policy}")
+        self.spool_dir = spool_dir
+        self.max_usage_percent = max_usage_percent
+        self.exts = exts
+        self.policy = policy
+        self.check_interval = check_interval
+        self.resync_interval = resync_interval
+        # when given the index is loaded from the catalogue instead of a scan
+        self.catalogue = catalogue
+        # files with these extensions next to a recording are deleted with it
+        self.sidecar_exts = sidecar_exts
+        # path -> (mtime, size) of every recording in the spool
+        self.files = {}
+        self.used = 0
+        self.capacity = 0
+        self.last_sync = None
+        self.full = False
+        self.evicted = 0
+        self.added = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.added.put(None)
+        self.thread.join()
+
+    def add(self, filename):
+        # called when a recording is saved, never blocks
+        self.added.put(filename)
+
+    def can_record(self):
+        return not self.full
+
+    @property
+    def usage_percent(self):
+        if not self.capacity:
+            return 0
+        return 100 * self.used / self.capacity
+
+    def stats(self):
+        return {
+            "files": len(self.files),
+            "usage_percent": self.usage_percent,
+            "full": self.full,
+            "evicted": self.evicted,
+        }
+
+    def run(self):
+        self.sync()
+        while not self.stopped.is_set():
+            try:
+                filename = self.added.get(timeout=self.check_interval)
+                if filename is not None:
+                    self.index(filename)
+            except queue.Empty:
+                pass
+            try:
+                if time.monotonic() - self.last_sync > self.resync_interval:
+                    self.sync()
+                self.check()
+            except Exception:
+                logging.exception("Error cleaning spool")
+
+    def sync(self):
+        usage = psutil.disk_usage(self.spool_dir)
+        self.used = usage.used
+        self.capacity = usage.used + usage.free
+        self.files = {}
+        with os.scandir(self.spool_dir) as entries:
+            for entry in entries:
+                ext = os.path.splitext(entry.name)[1]
+                if entry.is_file() and ext in self.exts:
+                    stat = entry.stat()
+                    self.files[entry.path] = (stat.st_mtime, stat.st_size)
+        if self.catalogue is not None:
+            # the catalogue orders clips by when they ended, rows for clips
+            # that have been uploaded or deleted are dropped
+            for clip in self.catalogue.query():
+                if clip["file"] in self.files:
+                    self.files[clip["file"]] = (
+                        clip["end_time"],
+                        self.files[clip["file"]][1],
+                    )
+                else:
+                    self.catalogue.remove(clip["file"])
+        self.last_sync = time.monotonic()
+
+    def index(self, filename):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return
+        previous = self.files.get(filename)
+        if previous is not None:
+            self.used -= previous[1]
+        self.files[filename] = (stat.st_mtime, stat.st_size)
+        self.used += stat.st_size
+
+    def check(self):
+        over = self.usage_percent > self.max_usage_percent
+        if over and self.policy == EVICT:
+            self.evict()
+            over = self.usage_percent > self.max_usage_percent
+        if over != self.full:
+            if over:
+                logging.warning(
+                    f"Spool is {self.usage_percent:.1f}% full, stopping recordings"
+                )
+            else:
+                logging.info(f"Spool is {self.usage_percent:.1f}% full, recording")
+        self.full = over
+
+    def evict(self):
+        oldest = sorted(self.files.items(), key=lambda item: item[1][0])
+        for filename, (_, size) in oldest:
+            if self.usage_percent <= self.max_usage_percent:
+                break
+            del self.files[filename]
+            if self.catalogue is not None:
+                self.catalogue.remove(filename)
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                # already removed, probably uploaded, so nothing was freed
+                continue
+            logging.info(f"Deleted {filename} to free disk space")
+            self.evicted += 1
+            self.used -= size
+            for ext in self.sidecar_exts:
+                try:
+                    os.remove(os.path.splitext(filename)[0] + ext)
+                except FileNotFoundError:
+                    pass
@@ -1,6 +1,5 @@
 #!/usr/bin/python3
 import cv2
-import psutil
 import socket
 import logging
 import sys
@@ -9,18 +8,46 @@ import shutil
 from datetime import datetime
 import glob
 import argparse
+import json
 import numpy as np
+import queue
+import signal
 import subprocess
+import threading
 import time
 
 from pathlib import Path
 import multiprocessing
 
+from background import AverageBackground
+from capture import CaptureThread, request_luma
+from catalogue import Catalogue, CATALOGUE_FILE
+from configwatcher import ConfigWatcher
+from encoder import EncoderThread, OpenCVWriter, make_writer, BLOCK, DEGRADE
+from janitor import SpoolJanitor, EVICT
+from framering import FrameRing
+from memwatch import CLOSE_CLIP, NORMAL, RESTART, SHED_PREVIEW, MemoryWatchdog
+from metrics import Metrics, MetricsWriter
+from motion import Motion
+from scheduler import WindowScheduler
+from slidingwindow import EncodedWindow
+from stills import StillWriter
+from telemetry import (
+    TELEMETRY_EXT,
+    ClipTelemetry,
+    TelemetryRing,
+    save_telemetry,
+    telemetry_file,
+)
+
 MAX_DISK_USAGE_PERCENT = 80
+SPOOL_POLICY = EVICT
 USB_DIR = "/media/cp"
 VIDEO_DIR = os.path.join(USB_DIR, "videos")
-TMP_DIR = "/tmp"
 VIDEO_DIR = "/var/spool/cptv"
+# clips are written here and renamed into VIDEO_DIR, it must be on the same
+# filesystem so the rename never turns into a copy
+TMP_DIR = os.path.join(VIDEO_DIR, "tmp")
 STILL_DIR = "/var/spool/cptv"
 FPS = 10
 H264_EXT = ".h264"
@@ -31,11 +58,39 @@ RESOLUTION = (640, 480)
 # VIDEO_EXT = "avi"
 FOURCC = cv2.VideoWriter_fourcc(*"avc1")
 VIDEO_EXT = "mp4"
+VIDEO_EXTS = [".mp4", ".avi"]
 MIN_FRAMES = 10 * FPS
 MAX_FRAMES = 120 * FPS
+# recordings are saved as clips of at most this many frames, so a power cut
+# only loses the clip being written
+SEGMENT_FRAMES = 30 * FPS
 FPS = 10
-WINDOW_SIZE = 5 * FPS
-PRINT_WAIT_TIMES = True
+MOTION_SCALE = 1
+# capture, detect and record only the luma plane, the ir camera is monochrome
+LUMA_ONLY = False
+CONFIG_MODEL = "ir"
+FRAME_SLOTS = 2 * FPS
+# must hold the background and all pre-roll frames written on a trigger
+ENCODE_QUEUE_SIZE = 8 * FPS
+ENCODE_POLICY = DEGRADE
+# snapshots of each process's metrics are written here for the fleet agent
+METRICS_DIR = "/run/ir-camera"
+METRICS_INTERVAL = 60
+# longest sleep outside the recording window before checking for config changes
+SCHEDULE_POLL = 60
+# MB the memory of both processes may grow over its first sample before the
+# pre-roll is shrunk, the clip is closed and then the recorder restarts. The
+# first sample already has a full pre-roll, the first level leaves room for a
+# full encode queue at 640x480
+MEMORY_HEADROOM_MB = (128, 192, 256)
+MEMORY_INTERVAL = 60
+# seconds between checks by the recorder that the capture process is alive
+PARENT_POLL = 1
+# the pre-roll is divided by this while memory is high
+SHED_PREVIEW_DIVISOR = 4
+# frames of traceback tracemalloc keeps for each allocation in the recorder,
+# 0 disables it as tracing slows every allocation
+TRACE_MEMORY = 0
 
 VERSION = 2.0
 hostname = socket.gethostname()
@@ -48,273 +103,822 @@ def init_logging():
     )
 
 
-def need_more_disk_space():
-    return psutil.disk_usage(VIDEO_DIR).percent > MAX_DISK_USAGE_PERCENT
-
-
 def parse_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
         "--source",
-        help='a Mp4/avi file to process, or a folder name, or "all" for all files within subdirectories of source folder.',
+        help="a Mp4/avi file to process, or a folder name to process all files within it and its subdirectories.",
+    )
+    parser.add_argument(
+        "--output",
+        default="batch",
+        help="folder to write recordings and the results manifest to when source is a folder",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes to use when source is a folder",
+    )
+    parser.add_argument(
+        "--luma",
+        action="store_true",
+        default=LUMA_ONLY,
+        help="capture and record grey frames, skipping colour conversion",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="process a file as fast as it can be read, timing clips by frame so every run records the same clips",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        type=int,
+        default=TRACE_MEMORY,
+        metavar="FRAMES",
+        help="trace the recorder's allocations with tracemalloc, keeping this many frames of each traceback",
     )
     args = parser.parse_args()
+    if args.replay and (args.source is None or is_camera(args.source)):
+        parser.error("--replay needs a file source")
 
     if args.source:
         args.source = Path(args.source)
+    args.output = Path(args.output)
     print(f"args f{args}")
     return args
 
 
+def pipeline_dir(directory, name):
+    # each named pipeline keeps its files in a sub folder
+    if name is None:
+        return directory
+    return os.path.join(directory, name)
+
+
 def run_recorder(frame_queue):
     init_logging()
-    os.makedirs(VIDEO_DIR, exist_ok=True)
-    os.makedirs(STILL_DIR, exist_ok=True)
-    headers = frame_queue.get()
+    # the capture process sends DONE on SIGTERM, so the clip is finished even
+    # when the whole service is signalled
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    parent = os.getppid()
+
+    def get_frame():
+        # a killed capture process never sends DONE, so stop once orphaned
+        while True:
+            try:
+                return frame_queue.get(timeout=PARENT_POLL)
+            except queue.Empty:
+                if os.getppid() != parent:
+                    logging.error("Capture process has stopped")
+                    return "DONE"
+
+    headers = get_frame()
+    if isinstance(headers, str):
+        frame_queue.close()
+        return
     width = headers["width"]
     height = headers["height"]
-    r = Recorder(width, height)
+    luma = headers.get("luma", False)
+    name = headers.get("name")
+    # frames of a replayed file are never dropped and clips are timed by frame
+    replay = headers.get("replay", False)
+    video_dir = pipeline_dir(VIDEO_DIR, name)
+    tmp_dir = pipeline_dir(TMP_DIR, name)
+    still_dir = pipeline_dir(STILL_DIR, name)
+    metrics_dir = pipeline_dir(METRICS_DIR, name)
+    os.makedirs(video_dir, exist_ok=True)
+    os.makedirs(still_dir, exist_ok=True)
+    os.makedirs(tmp_dir, exist_ok=True)
+    catalogue = Catalogue(
+        os.path.join(
+            pipeline_dir(os.path.dirname(CATALOGUE_FILE), name),
+            os.path.basename(CATALOGUE_FILE),
+        )
+    )
+    recover_clips(tmp_dir, video_dir, catalogue)
+    janitor = SpoolJanitor(
+        video_dir,
+        MAX_DISK_USAGE_PERCENT,
+        VIDEO_EXTS,
+        policy=SPOOL_POLICY,
+        catalogue=catalogue,
+        sidecar_exts=[TELEMETRY_EXT],
+    )
+    janitor.start()
+    config_watcher = ConfigWatcher(model=CONFIG_MODEL)
+    config_watcher.start()
+
+    def memory_stats():
+        return {
+            "frame_ring_occupancy": frame_queue.occupancy,
+            "encode_queue_depth": r.encoder.queue.qsize(),
+            "stills_queue_depth": r.stills.queue.qsize(),
+            "preview_mb": r.motion_detector.preview_frames.nbytes / 1024 / 1024,
+        }
+
+    memory_watchdog = MemoryWatchdog(
+        os.path.join(metrics_dir, "memory.jsonl"),
+        MEMORY_HEADROOM_MB,
+        processes={"capture": parent, "recorder": os.getpid()},
+        interval=MEMORY_INTERVAL,
+        collect=memory_stats,
+        trace_frames=headers.get("trace_memory", TRACE_MEMORY),
+    )
+    r = Recorder(
+        width,
+        height,
+        video_dir=video_dir,
+        tmp_dir=tmp_dir,
+        still_dir=still_dir,
+        name_prefix=headers.get("name_prefix"),
+        encode_policy=BLOCK if replay else ENCODE_POLICY,
+        janitor=janitor,
+        catalogue=catalogue,
+        config_watcher=config_watcher,
+        luma=luma,
+        frame_clock=replay,
+        memory_watchdog=memory_watchdog,
+    )
+    memory_watchdog.metrics = r.metrics
+    memory_watchdog.start()
+    metrics_writer = MetricsWriter(
+        r.metrics, os.path.join(metrics_dir, "recorder.json"), METRICS_INTERVAL
+    )
+    metrics_writer.start()
     frames = 0
+    restart = False
     while True:
         frames += 1
-        frame = frame_queue.get()
+        frame = get_frame()
         if isinstance(frame, str):
+            if frame == "SUSPEND":
+                r.suspend()
+                continue
             logging.info("Got all frames")
             r.close()
             break
+        now = time.monotonic()
+        r.metrics.observe("queue_transit", (now - frame_queue.put_time) * 1000)
+        r.metrics.observe("capture_latency", (now - frame_queue.frame_time) * 1000)
         r.process_frame(frame)
+        if r.memory_level >= RESTART:
+            logging.error("Memory is over its limit, restarting")
+            r.close()
+            restart = True
+            break
+    frame_queue.close()
+    memory_watchdog.stop()
+    config_watcher.stop()
+    janitor.stop()
+    catalogue.close()
+    metrics_writer.stop()
+    if restart:
+        # a non zero exit stops capture and the service restarts both
+        sys.exit(1)
+
+
+def recover_clips(tmp_dir, video_dir, catalogue=None):
+    # clips left in tmp_dir by a crash or power cut are moved into the spool if
+    # they can still be read, otherwise deleted
+    with os.scandir(tmp_dir) as entries:
+        files = [entry for entry in entries if entry.is_file()]
+    for entry in files:
+        cap = cv2.VideoCapture(entry.path)
+        readable = cap.isOpened() and cap.read()[0]
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        if not readable:
+            logging.warning(f"Deleting unfinished clip {entry.path}")
+            os.remove(entry.path)
+            continue
+        stat = entry.stat()
+        out_file = os.path.join(video_dir, entry.name)
+        os.rename(entry.path, out_file)
+        logging.info(f"Recovered unfinished clip {out_file}")
+        if catalogue is not None:
+            catalogue.add(
+                {
+                    "file": out_file,
+                    "start_time": stat.st_mtime - max(frames, 0) / FPS,
+                    "end_time": stat.st_mtime,
+                    "frames": frames,
+                    "trigger_reason": "motion",
+                    "stop_reason": "recovered",
+                    "size": stat.st_size,
+                }
+            )
 
 
 class Recorder:
-    def __init__(self, res_x, res_y):
-        self.motion_detector = Motion()
+    def __init__(
+        self,
+        res_x,
+        res_y,
+        video_dir=VIDEO_DIR,
+        tmp_dir=TMP_DIR,
+        still_dir=STILL_DIR,
+        name_prefix=None,
+        encode_policy=ENCODE_POLICY,
+        janitor=None,
+        catalogue=None,
+        config_watcher=None,
+        luma=False,
+        segment_frames=SEGMENT_FRAMES,
+        frame_clock=False,
+        memory_watchdog=None,
+    ):
+        self.motion_detector = Motion(
+            background=AverageBackground(), scale=MOTION_SCALE
+        )
         self.recording = False
         self.res_x = res_x
         self.res_y = res_y
-        self.writer = None
+        # frames are grey and clips are recorded in grey
+        self.luma = luma
+        self.video_dir = video_dir
+        self.tmp_dir = tmp_dir
+        self.still_dir = still_dir
+        # when set clips are named by prefix and frame number instead of time
+        self.name_prefix = name_prefix
+        # clips are timed in seconds from the first frame instead of the wall
+        # clock, so processing a file gives the same clips every run
+        self.frame_clock = frame_clock
+        self.janitor = janitor
+        self.catalogue = catalogue
+        self.metrics = Metrics("recorder")
+        self.metrics.add_collector(self.collect_metrics)
+        self.encoder = EncoderThread(
+            OpenCVWriter(FOURCC, FPS),
+            max_queue=ENCODE_QUEUE_SIZE,
+            policy=encode_policy,
+            metrics=self.metrics,
+            on_saved=self.clip_saved,
+            on_failed=self.clip_failed,
+        )
+        # no stills are written without a still_dir
+        self.stills = None
+        if still_dir is not None:
+            self.stills = StillWriter(still_dir, metrics=self.metrics)
+        self.segment_frames = segment_frames
+        # frames recorded since the trigger and since the current clip started
         self.length = 0
-        # self.config = ThermalConfig.load_from_file()
+        self.clip_length = 0
+        self.segment = 0
+        self.frame_num = 0
+        self.start_frame = 0
+        self.start_time = None
+        self.preroll = 0
+        self.trigger_reason = None
+        self.peak_motion = 0
+        self.peak_frame = None
+        self.motion_sum = 0
+        self.track_ids = set()
+        self.max_speed = 0
+        # motion telemetry for the pre-roll and for the clip being recorded,
+        # saved beside each clip once it is in the spool
+        self.recent_telemetry = TelemetryRing(
+            self.motion_detector.preview_frames.frame_len
+        )
+        self.telemetry = ClipTelemetry()
+        self.pending_telemetry = {}
+        # clips saved to the spool and clips the encoder could not save
+        self.recordings = []
+        self.failed_recordings = []
+        self.min_frames = MIN_FRAMES
+        self.max_frames = MAX_FRAMES
+        self.disable_recordings = False
+        # config is reapplied between frames whenever the watcher reloads it
+        self.config_watcher = config_watcher
+        self.config_version = None
+        # memory is freed between frames as the watchdog's level rises
+        self.memory_watchdog = memory_watchdog
+        self.memory_level = NORMAL
+        self.preview_length = (self.motion_detector.preview_frames.frame_len, None)
 
     def close(self):
         if self.recording:
-            logging.info("Stopping recording")
-            self.writer.release()
-            self.recording = False
+            self.stop_recording("closed")
+        self.encoder.stop()
+        if self.stills is not None:
+            self.stills.stop()
+
+    def suspend(self):
+        # nothing will be captured until the recording window opens again,
+        # keep the background for a warm start but drop frames that will be stale
+        if self.recording:
+            self.stop_recording("window closed")
+        self.motion_detector.reset()
+
+    def collect_metrics(self, metrics):
+        metrics.set("encode_queue_depth", self.encoder.queue.qsize())
+        metrics.set("encode_queue_max_depth", self.encoder.max_depth)
+        metrics.set("frames_dropped_encoder", self.encoder.dropped)
+        for key, value in self.motion_detector.mode_stats().items():
+            metrics.set(f"motion_{key}", value)
+        if self.janitor is not None:
+            for key, value in self.janitor.stats().items():
+                metrics.set(f"spool_{key}", value)
+
+    def now(self):
+        if self.frame_clock:
+            return self.frame_num / FPS
+        return time.time()
+
+    def start_clip(self, preroll, trigger_reason):
+        self.clip_length = 0
+        self.start_frame = self.frame_num
+        # the first frame always sets the peak
+        self.peak_motion = -1
+        self.motion_sum = 0
+        self.track_ids = set()
+        self.max_speed = 0
+        self.preroll = preroll
+        self.trigger_reason = trigger_reason
+        self.telemetry.clear()
+        self.start_time = self.now() - preroll / FPS
+        self.filename = self.get_file_name()
+        self.tmp_file = os.path.join(self.tmp_dir, self.filename)
+        logging.info(f"Starting new recording: {self.tmp_file}")
+        self.encoder.open(
+            self.tmp_file, (self.res_x, self.res_y), is_color=not self.luma
+        )
+
+    def finish_clip(self, reason):
+        out_file = os.path.join(self.video_dir, self.filename)
+        clip_name = os.path.splitext(self.filename)[0]
+        stills_dir = None
+        if self.stills is not None:
+            self.stills.write(self.peak_frame, "peak", clip_name)
+            last_frame = self.motion_detector.preview_frames.newest
+            if last_frame is not None:
+                self.stills.write(last_frame, "last", clip_name)
+            stills_dir = self.stills.get_clip_dir(clip_name)
+        clip = {
+            "file": out_file,
+            "start_frame": self.start_frame,
+            "start_time": self.start_time,
+            "end_time": self.now(),
+            "frames": self.preroll + self.clip_length,
+            "peak_motion": self.peak_motion,
+            "mean_motion": self.motion_sum / max(self.clip_length, 1),
+            "tracks": len(self.track_ids),
+            "max_speed": self.max_speed,
+            "segment": self.segment,
+            "trigger_reason": self.trigger_reason,
+            "stop_reason": reason,
+            "stills": stills_dir,
+            "telemetry": telemetry_file(out_file),
+        }
+        # handed to the encoder thread, which saves it once the clip is saved
+        self.pending_telemetry[out_file] = self.telemetry.get_rows()
+        # a rename on the same filesystem, so finishing a clip is cheap
+        self.encoder.close(self.tmp_file, out_file, clip)
+
+    def next_segment(self):
+        self.finish_clip("segment")
+        self.segment += 1
+        self.start_clip(0, "continued")
+
+    def stop_recording(self, reason):
+        logging.info("Stopping recording")
+        self.metrics.inc("recordings")
+        self.finish_clip(reason)
+        self.recording = False
+
+    def clip_saved(self, out_file, clip):
+        # called on the encoder thread once the clip is in the spool
+        clip["size"] = os.path.getsize(out_file)
+        self.recordings.append(clip)
+        rows = self.pending_telemetry.pop(out_file, None)
+        if rows is not None:
+            save_telemetry(telemetry_file(out_file), rows, FPS)
+        if self.catalogue is not None:
+            self.catalogue.add(clip)
+        if self.janitor is not None:
+            self.janitor.add(out_file)
+
+    def clip_failed(self, out_file, clip):
+        # called on the encoder thread when the clip could not be written
+        self.pending_telemetry.pop(out_file, None)
+        self.failed_recordings.append(clip)
+        self.metrics.inc("recordings_failed")
+
+    def update_clip_motion(self, frame):
+        erosion_pixels = self.motion_detector.erosion_pixels
+        if erosion_pixels > self.peak_motion:
+            # kept until the clip ends, so only one peak still is encoded
+            if self.peak_frame is None or self.peak_frame.shape != frame.shape:
+                self.peak_frame = frame.copy()
+            else:
+                np.copyto(self.peak_frame, frame)
+            self.peak_motion = erosion_pixels
+        self.motion_sum += erosion_pixels
+        tracks = self.motion_detector.tracks
+        if len(tracks):
+            self.track_ids.update(tracks["id"].tolist())
+            speed = np.hypot(tracks["vx"], tracks["vy"]).max()
+            self.max_speed = max(self.max_speed, float(speed))
+
+    def set_config(self, config):
+        logging.info(f"Applying config {config.motion} {config.recorder}")
+        self.min_frames = int(config.recorder.min_secs * FPS)
+        self.max_frames = int(config.recorder.max_secs * FPS)
+        self.disable_recordings = config.recorder.disable_recordings
+        try:
+            self.encoder.set_writer(make_writer(config.encoder, FOURCC, FPS))
+        except ValueError:
+            logging.exception("Keeping the current encoder")
+        self.motion_detector.set_config(config.motion)
+        self.preview_length = (
+            int(config.recorder.preview_secs * FPS),
+            config.recorder.preview_quality,
+        )
+        self.apply_preview_length()
+
+    def apply_preview_length(self):
+        frames, quality = self.preview_length
+        if self.memory_level >= SHED_PREVIEW:
+            frames = max(1, frames // SHED_PREVIEW_DIVISOR)
+        self.motion_detector.set_preview_length(frames, quality)
+
+    def set_memory_level(self, level):
+        logging.warning(f"Memory level {self.memory_level} -> {level}")
+        if level > self.memory_level:
+            self.metrics.inc("memory_escalations")
+        shed = (level >= SHED_PREVIEW) != (self.memory_level >= SHED_PREVIEW)
+        self.memory_level = level
+        # the clip is finished first as its last still comes from the pre-roll
+        if level >= CLOSE_CLIP and self.recording:
+            self.stop_recording("memory")
+        if shed:
+            self.apply_preview_length()
 
     def process_frame(self, frame):
-        motion = self.motion_detector.process_frame(frame.copy())
+        if (
+            self.config_watcher is not None
+            and self.config_watcher.version != self.config_version
+        ):
+            self.config_version = self.config_watcher.version
+            self.set_config(self.config_watcher.config)
+        if (
+            self.memory_watchdog is not None
+            and self.memory_watchdog.level != self.memory_level
+        ):
+            self.set_memory_level(self.memory_watchdog.level)
+        idle = self.motion_detector.idle
+        start = time.perf_counter()
+        motion = self.motion_detector.process_frame(frame)
+        detect_ms = (time.perf_counter() - start) * 1000
+        self.metrics.observe("detection_idle" if idle else "detection", detect_ms)
+        self.metrics.inc("frames")
+        self.frame_num += 1
+        row = (
+            self.frame_num,
+            self.now(),
+            self.motion_detector.delta_pixels,
+            self.motion_detector.erosion_pixels,
+            self.motion_detector.motion_count,
+            motion,
+            idle,
+            detect_ms,
+        )
+        previews = self.motion_detector.preview_frames
+        if self.recent_telemetry.size != previews.frame_len:
+            self.recent_telemetry = TelemetryRing(previews.frame_len)
+        # pre-roll frames are always recorded
+        self.recent_telemetry.add(row + (True,))
         if not self.recording and motion:
+            if self.disable_recordings:
+                return
+            if self.janitor is not None and not self.janitor.can_record():
+                self.metrics.inc("frames_not_recorded_disk_full")
+                return
+            if self.memory_level >= CLOSE_CLIP:
+                self.metrics.inc("frames_not_recorded_memory")
+                return
+            self.metrics.inc("triggers")
             self.length = 0
-            self.filename = self.get_file_name()
-            self.tmp_file = os.path.join(TMP_DIR, self.filename)
-            logging.info(f"Starting new recording: {self.tmp_file}")
-            self.writer = cv2.VideoWriter(
-                self.tmp_file, FOURCC, FPS, (self.res_x, self.res_y)
-            )
+            self.segment = 0
+            # the clip starts with the pre-roll
+            self.start_clip(len(self.motion_detector.preview_frames), "motion")
             self.recording = True
-            cv2.imwrite(os.path.join(STILL_DIR, "still.png"), frame)
-            previews = self.motion_detector.preview_frames.get_frames()
-            self.writer.write(self.motion_detector.get_background())
-            for f in previews:
-                self.writer.write(f)
-        elif (self.recording and not motion and self.length > MIN_FRAMES) or (
-            self.length >= MAX_FRAMES
-        ):
-            logging.info("Stopping recording")
-            self.writer.release()
-            out_file = os.path.join(VIDEO_DIR, self.filename)
-            logging.info(f"Saving file to {out_file}")
-            os.rename(self.tmp_file, out_file)
-            self.recording = False
+            if self.stills is not None:
+                self.stills.write(frame, "still")
+                self.stills.write(
+                    frame, "trigger", os.path.splitext(self.filename)[0]
+                )
+            # never drop pre-roll, the queue is sized to hold all of it
+            self.telemetry.extend(self.recent_telemetry.newest(len(previews)))
+            background = self.motion_detector.get_background()
+            if not self.luma:
+                background = cv2.cvtColor(background, cv2.COLOR_GRAY2BGR)
+            self.encoder.write(background, block=True)
+            if isinstance(previews, EncodedWindow):
+                # decoded on the encoder thread
+                for data in previews.get_encoded():
+                    self.encoder.write_encoded(data, block=True)
+            else:
+                for f in previews.get_frames():
+                    self.encoder.write(f, block=True)
+            self.update_clip_motion(frame)
+        elif self.recording and not motion and self.length > self.min_frames:
+            self.stop_recording("no motion")
+        elif self.recording and self.length >= self.max_frames:
+            self.stop_recording("max length")
         elif self.recording:
-            self.writer.write(frame)
+            if self.clip_length >= self.segment_frames:
+                self.next_segment()
+            recorded = self.encoder.write(frame)
+            self.telemetry.add(row + (recorded,))
             self.length += 1
+            self.clip_length += 1
+            self.update_clip_motion(frame)
 
     def get_file_name(self):
-        date_str = datetime.utcnow().strftime("%Y-%m-%d_%H.%M.%S")
+        if self.name_prefix is not None:
+            return f"{self.name_prefix}_{self.frame_num:06d}.{VIDEO_EXT}"
+        date_str = datetime.utcfromtimestamp(self.now()).strftime("%Y-%m-%d_%H.%M.%S")
         return f"{date_str}_{hostname}_{VERSION}.{VIDEO_EXT}"
 
 
-class Background:
-    AVERAGE_OVER = 1000
-
-    def __init__(self):
-        self._background = None
-        self.frames = 0
-
-    def process_frame(self, frame):
-        if self._background is None:
-            self._background = np.float32(frame.copy())
-            return
-        if self.frames < Background.AVERAGE_OVER:
-            self._background = (self._background * self.frames + frame) / (
-                self.frames + 1
-            )
-        else:
-            self._background = (
-                self._background * (Background.AVERAGE_OVER - 1) + frame
-            ) / (Background.AVERAGE_OVER)
-
-        self.frames += 1
-
-    @property
-    def background(self):
-        return np.uint8(self._background)
-
-
-class SlidingWindow:
-    def __init__(self, size):
-        # might not need lock
-        self.frame_len = size
-        self.frames = [None] * size
-        self.i = 0
-
-    def add(self, frame):
-        self.frames[self.i] = frame
-        self.i += 1
-        self.i = self.i % self.frame_len
-
-    @property
-    def oldest(self):
-        return self.frames[self.i]
-
-    def get_frames(self):
-        frames = []
-        cur = self.i
-        # end_index = (cur + 1) % self.frame_len
-        while len(frames) == 0 or cur != self.i:
-            frames.append(self.frames[cur])
-            cur = (cur + 1) % self.frame_len
-        return frames
-
-
-class Motion:
-    def __init__(self):
-        self.preview_frames = SlidingWindow(WINDOW_SIZE)
-        self.preview_frames_grey = SlidingWindow(WINDOW_SIZE)
-        self.background = Background()
-        self.kernel_trigger = np.ones(
-            (15, 15), "uint8"
-        )  # kernel for erosion when not recording
-        self.kernel_recording = np.ones(
-            (10, 10), "uint8"
-        )  # kernel for erosion when recording
-        self.motion = False
-        self.motion_count = 0
-        self.show = False
-
-    def get_background(self):
-        return self.background.background
-
-    def get_kernel(self):
-        if self.motion:
-            return self.kernel_recording
-        else:
-            return self.kernel_trigger
-
-    # Processes a frame returning True if there is motion.
-    def process_frame(self, frame):
-        self.preview_frames.add(frame)
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        self.preview_frames_grey.add(frame)
-
-        if self.preview_frames_grey.oldest is None:
-            return False
-
-        # Filter and get diff from background
-        delta = cv2.absdiff(
-            self.preview_frames_grey.oldest, frame
-        )  # Get delta from current frame and background
-        threshold = cv2.threshold(delta, 25, 255, cv2.THRESH_BINARY)[1]
-
-        erosion_image = cv2.erode(threshold, self.get_kernel())
-        erosion_pixels = len(erosion_image[erosion_image > 0])
-        # to do find a value that suites the number of pixesl we want to move
-        self.preview_frames_grey.add(frame)
-        self.background.process_frame(frame)
-        # Calculate if there was motion in the current frame
-        # TODO Chenage how much ioldests added to the motion_count depending on how big the motion is
-        if erosion_pixels > 0:
-            self.motion_count += 1
-            self.motion_count = min(self.motion_count, 30)
-        else:
-            self.motion_count -= 1
-            self.motion_count = max(self.motion_count, 0)
+def init_batch_worker():
+    init_logging()
+    # one file per process, so stop opencv spawning threads of its own
+    cv2.setNumThreads(1)
+
+
+def find_videos(folder):
+    return sorted(p for p in folder.rglob("*") if p.suffix.lower() in VIDEO_EXTS)
+
+
+def process_file(source, root, output):
+    # run a file through the recorder as fast as it can be read
+    start = time.time()
+    clip_dir = output / source.relative_to(root).parent
+    os.makedirs(clip_dir, exist_ok=True)
+    result = {"source": str(source)}
+    try:
+        cap = cv2.VideoCapture(str(source))
+        if not cap.isOpened():
+            raise ValueError(f"Could not open {source}")
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        r = Recorder(
+            width,
+            height,
+            video_dir=clip_dir,
+            tmp_dir=clip_dir,
+            # stills of every file would share one folder and rotate each
+            # other's out, so only the clips and telemetry are kept
+            still_dir=None,
+            name_prefix=source.stem,
+            encode_policy=BLOCK,
+            frame_clock=True,
+        )
+        motion_frames = 0
+        while True:
+            returned, frame = cap.read()
+            if not returned:
+                break
+            r.process_frame(frame)
+            motion_frames += r.motion_detector.motion
+        cap.release()
+        r.close()
+        result["frames"] = r.frame_num
+        result["motion_frames"] = motion_frames
+        result["recordings"] = r.recordings
+        result["failed_recordings"] = r.failed_recordings
+    except Exception as e:
+        logging.exception(f"Error processing {source}")
+        result["error"] = str(e)
+    result["seconds"] = time.time() - start
+    return result
+
+
+def run_batch(root, output, workers):
+    files = find_videos(root)
+    logging.info(f"Processing {len(files)} files from {root} with {workers} workers")
+    start = time.time()
+    os.makedirs(output, exist_ok=True)
+    with multiprocessing.Pool(workers, initializer=init_batch_worker) as pool:
+        results = pool.starmap(
+            process_file, [(source, root, output) for source in files]
+        )
+    manifest = {
+        "source": str(root),
+        "version": VERSION,
+        "seconds": time.time() - start,
+        "files": results,
+        "errors": sum(
+            ("error" in r) + len(r.get("failed_recordings", [])) for r in results
+        ),
+        "recordings": sum(len(r.get("recordings", [])) for r in results),
+    }
+    manifest_file = output / "manifest.json"
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+    logging.info(
+        f"Processed {len(files)} files in {manifest['seconds']:.1f}s, "
+        f"{manifest['recordings']} recordings, {manifest['errors']} errors, "
+        f"manifest saved to {manifest_file}"
+    )
 
-        # logging.info("motion count is %s", self.motion_count)
-        # Check if motion has started or ended
-        if not self.motion and self.motion_count > 10:
-            self.motion = True
 
-        elif self.motion and self.motion_count <= 0:
-            self.motion = False
+def is_camera(source):
+    # None is the default camera, otherwise a camera index or device
+    return (
+        source is None
+        or isinstance(source, int)
+        or str(source).startswith("/dev/video")
+    )
 
-        if self.show:
-            cv2.imshow("window", frame)
-            cv2.imshow("delta", delta)
-            cv2.imshow("threshold", threshold)
-            cv2.imshow("erosion_image", erosion_image)
-            cv2.imshow("background", self.background.background)
 
-            cv2.moveWindow(f"window", 0, 0)
-            cv2.moveWindow(f"delta", 640, 0)
-            cv2.moveWindow(f"erosion_image", 0, 480)
-            cv2.moveWindow(f"threshold", 640, 480)
-            cv2.moveWindow(f"background", 1000, 960)
+def open_capture(source, luma=False):
+    if is_camera(source):
+        cap = cv2.VideoCapture(0 if source is None else source)
+        if luma:
+            fourcc = request_luma(cap)
+            if fourcc is None:
+                logging.warning("Camera would not give luma frames, converting")
+            else:
+                logging.info(f"Capturing {fourcc} frames")
+        return cap
+    return cv2.VideoCapture(str(source))
 
-            cv2.waitKey(1)
 
-        return self.motion
+def get_scheduler(config):
+    window = config.recorder.rec_window
+    if window.use_sunrise_sunset():
+        lat, lng = config.location.get_lat_long(use_default=True)
+        window.set_location(lat, lng, config.location.altitude or 0)
+    return WindowScheduler(window)
 
 
 def main():
     init_logging()
 
     args = parse_args()
-    if args.source is None:
-        cap = cv2.VideoCapture(0)
-    else:
-        cap = cv2.VideoCapture(str(args.source))
+    if args.source is not None and args.source.is_dir():
+        run_batch(args.source, args.output, args.workers)
+        return
+    sys.exit(
+        run_pipeline(
+            args.source,
+            args.luma,
+            replay=args.replay,
+            trace_memory=args.trace_memory,
+        )
+    )
+
+
+def run_pipeline(
+    source, luma=False, name=None, cpus=None, replay=False, trace_memory=TRACE_MEMORY
+):
+    # captures from source and records in a child process until the source
+    # ends or SIGTERM, returns non zero if the recorder process failed.
+    # A named pipeline records and writes metrics to its own sub folders.
+    # A replayed file is read as fast as the recorder keeps up, waiting for it
+    # rather than dropping frames, and clips are named and timed by frame
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    cap = open_capture(source, luma)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     # FPS = int(cap.get(cv2.CAP_PROP_FPS))
     # print(FPS)
-    frame_queue = multiprocessing.Queue()
+    shape = (height, width) if luma else (height, width, 3)
+    frame_queue = FrameRing(shape, slots=FRAME_SLOTS)
     p_processor = multiprocessing.Process(
         target=run_recorder,
         args=(frame_queue,),
     )
     p_processor.start()
+    # set after starting the recorder, which finishes when sent DONE
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
 
     # Start video capture
     logging.info("Starting video capture")
-    headers = {"width": width, "height": height}
+    headers = {
+        "width": width,
+        "height": height,
+        "luma": luma,
+        "name": name,
+        "replay": replay,
+        "trace_memory": trace_memory,
+    }
+    if replay:
+        headers["name_prefix"] = Path(source).stem
     frame_queue.put(headers)
-    frame_count = 0.0
-    start_time = time.time()
-    wait_times = []
-    while True:
-        # Wait for next capture.
-        wait_time = max(0, start_time + frame_count / FPS - time.time())
-        time.sleep(wait_time)
-        wait_times.append(wait_time)
-        returned, frame = cap.read()
-        frame_count += 1
-        if frame_count % 10 * FPS == 0 and PRINT_WAIT_TIMES:
-            print("wait times between frames:")
-            print("Max:", max(wait_times))
-            print("Min:", min(wait_times))
-            print("Avg:", sum(wait_times) / len(wait_times))
-            wait_times = []
-        if not returned:
-            logging.info("no frame from video capture")
+    # only a live camera is limited to the recording window
+    config_watcher = None
+    if is_camera(source):
+        config_watcher = ConfigWatcher(model=CONFIG_MODEL)
+        config_watcher.start()
+    config_version = None
+    scheduler = None
+    metrics = Metrics("capture")
+    capture = None
+
+    def collect_metrics(m):
+        m.set("frames_dropped_transport", frame_queue.dropped.value)
+        if capture is not None:
+            for key, value in capture.stats().items():
+                m.set(key, value)
+
+    metrics.add_collector(collect_metrics)
+    metrics_writer = MetricsWriter(
+        metrics,
+        os.path.join(pipeline_dir(METRICS_DIR, name), "capture.json"),
+        METRICS_INTERVAL,
+    )
+
+    def replay_put(frame, timestamp):
+        # the ring bounds how far ahead of the recorder a replay reads
+        while not frame_queue.put(frame, timestamp, block=True, timeout=1):
+            if not p_processor.is_alive() or stopping.is_set():
+                return False
+        return True
+
+    metrics_writer.start()
+    while p_processor.is_alive() and not stopping.is_set():
+        if config_watcher is not None and config_watcher.version != config_version:
+            config_version = config_watcher.version
+            scheduler = get_scheduler(config_watcher.config)
+        next_change = None
+        if scheduler is not None:
+            inside, next_change = scheduler.next_transition()
+            if not inside:
+                if cap is not None:
+                    logging.info(f"Outside recording window until {next_change}")
+                    cap.release()
+                    cap = None
+                    metrics.set("suspended", True)
+                # wake now and then to notice config changes
+                stopping.wait(
+                    min(
+                        max((next_change - datetime.now()).total_seconds(), 0),
+                        SCHEDULE_POLL,
+                    )
+                )
+                continue
+        if cap is None:
+            logging.info("Resuming video capture")
+            cap = open_capture(source, luma)
+            metrics.set("suspended", False)
+
+        if replay:
+            capture = CaptureThread(cap, None, replay_put, metrics=metrics, luma=luma)
+        else:
+            capture = CaptureThread(
+                cap,
+                FPS,
+                frame_queue.put,
+                ready=frame_queue.has_space,
+                metrics=metrics,
+                luma=luma,
+            )
+        capture.start()
+        window_closed = False
+        while capture.is_alive():
+            capture.join(1)
+            if config_watcher is not None and config_watcher.version != config_version:
+                # a recording window may have been added or changed
+                config_version = config_watcher.version
+                scheduler = get_scheduler(config_watcher.config)
+                inside, next_change = scheduler.next_transition()
+                if not inside:
+                    next_change = datetime.now()
+            if not p_processor.is_alive():
+                logging.error("Recorder process has stopped")
+                capture.stop()
+            elif stopping.is_set():
+                logging.info("Stopping video capture")
+                capture.stop()
+            elif next_change is not None and datetime.now() >= next_change:
+                logging.info("Recording window has closed")
+                window_closed = True
+                capture.stop()
+        logging.info(f"Capture stats {capture.stats()}")
+        if not window_closed:
             break
-        # frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame_queue.put(frame)
+        # let the recorder finish its clip and sleep until frames resume
+        frame_queue.put("SUSPEND")
+        metrics.inc("suspends")
+
+    if cap is not None:
+        cap.release()
+    if config_watcher is not None:
+        config_watcher.stop()
     frame_queue.put("DONE")
     p_processor.join()
+    metrics_writer.stop()
+    logging.info(f"Frame ring stats {frame_queue.stats()}")
+    frame_queue.unlink()
     cv2.destroyAllWindows()
+    return 0 if p_processor.exitcode == 0 else 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+""" Samples the memory of the pipeline's processes on a slow timer, appending
+each sample to a rolling JSON lines file, and raises an escalation level as
+memory crosses its limits so the recorder can free memory before the OOM killer
+stops it
+"""
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+import psutil
+
+# escalation levels, each also applies the ones before it
+NORMAL = 0
+SHED_PREVIEW = 1  # shrink the pre-roll
+CLOSE_CLIP = 2  # finish the current clip and start no new ones
+RESTART = 3  # exit so the service restarts
+# a level is only lowered once memory is this far under its limit
+RECOVER_RATIO = 0.9
+# the file is rolled over to filename.1 when it grows past this
+MAX_LOG_BYTES = 1024 * 1024
+# allocations reported per sample when tracing
+TRACE_TOP = 10
+
+
+class MemoryWatchdog:
+    # processes maps a name to a pid, headroom_mb is how far the total memory
+    # of all of them may grow over the first sample before each level after
+    # NORMAL starts. Memory is measured as PSS, so pages shared between the
+    # processes, such as the frame ring and libraries, are only counted once.
+    # collect() returns any other values to save with a sample, such as queue
+    # depths. With trace_frames set tracemalloc records allocations in this
+    # process and the largest growths since the last sample are saved too
+    def __init__(
+        self,
+        filename,
+        headroom_mb,
+        processes=None,
+        interval=60,
+        collect=None,
+        trace_frames=0,
+        metrics=None,
+        max_bytes=MAX_LOG_BYTES,
+    ):
+        if len(headroom_mb) != RESTART:
+            raise ValueError(f"Expected {RESTART} memory limits got {headroom_mb}")
+        self.filename = filename
+        self.headroom_mb = headroom_mb
+        # set from the first sample, which is taken once the pipeline is
+        # running so the pre-roll is already full
+        self.baseline_mb = None
+        self.limits_mb = None
+        if processes is None:
+            processes = {"main": os.getpid()}
+        self.processes = {name: psutil.Process(pid) for name, pid in processes.items()}
+        self.interval = interval
+        self.collect = collect
+        self.trace_frames = trace_frames
+        self.metrics = metrics
+        self.max_bytes = max_bytes
+        self.snapshot = None
+        # read by the recorder between frames
+        self.level = NORMAL
+        self.peak_mb = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        if self.trace_frames:
+            tracemalloc.start(self.trace_frames)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.trace_frames:
+            tracemalloc.stop()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                logging.exception("Error sampling memory")
+
+    def get_memory(self):
+        memory = {}
+        for name, process in self.processes.items():
+            try:
+                info = process.memory_full_info()
+            except psutil.NoSuchProcess:
+                memory[name] = 0
+                continue
+            # pss is only on linux, uss still leaves out shared pages
+            memory[name] = getattr(info, "pss", info.uss) / 1024 / 1024
+        return memory
+
+    def get_level(self, total_mb):
+        if self.limits_mb is None:
+            self.baseline_mb = total_mb
+            self.limits_mb = [total_mb + headroom for headroom in self.headroom_mb]
+        level = sum(total_mb >= limit for limit in self.limits_mb)
+        if level >= self.level:
+            return level
+        # step down one level at a time so a level does not flap at its limit
+        if total_mb < self.limits_mb[self.level - 1] * RECOVER_RATIO:
+            return self.level - 1
+        return self.level
+
+    def top_allocations(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        if self.snapshot is None:
+            stats = snapshot.statistics("lineno")
+        else:
+            stats = snapshot.compare_to(self.snapshot, "lineno")
+        self.snapshot = snapshot
+        return [
+            {
+                "where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "kb": stat.size / 1024,
+                "growth_kb": getattr(stat, "size_diff", stat.size) / 1024,
+                "count": stat.count,
+            }
+            for stat in stats[:TRACE_TOP]
+        ]
+
+    def sample(self):
+        memory = self.get_memory()
+        total_mb = sum(memory.values())
+        self.peak_mb = max(self.peak_mb, total_mb)
+        level = self.get_level(total_mb)
+        if level != self.level:
+            log = logging.warning if level > self.level else logging.info
+            log(
+                f"Memory {total_mb:.0f}MB {memory} limits {self.limits_mb}, "
+                f"level {self.level} -> {level}"
+            )
+            self.level = level
+        record = {
+            "time": time.time(),
+            "pss_mb": memory,
+            "total_mb": total_mb,
+            "baseline_mb": self.baseline_mb,
+            "level": self.level,
+        }
+        if self.collect is not None:
+            record.update(self.collect())
+        if self.trace_frames:
+            record["allocations"] = self.top_allocations()
+        if self.metrics is not None:
+            self.metrics.set("memory_mb", total_mb)
+            self.metrics.set("memory_peak_mb", self.peak_mb)
+            self.metrics.set("memory_level", self.level)
+        self.write(record)
+        return record
+
+    def write(self, record):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        try:
+            if os.path.getsize(self.filename) > self.max_bytes:
+                os.replace(self.filename, f"{self.filename}.1")
+        except FileNotFoundError:
+            pass
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(record) + "\n")
@@ -0,0 +1,111 @@
+""" Fixed bucket latency histograms and counters, snapshots are written to a
+file by a background thread so the frame loop only does some arithmetic
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+# bucket upper bounds in ms, the last bucket holds anything slower
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def as_dict(self):
+        return {
+            "buckets_ms": self.buckets,
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum_ms": self.sum,
+            "max_ms": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        # called before each snapshot to pull values kept elsewhere
+        self.collectors = []
+
+    def observe(self, name, ms):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+        histogram.observe(ms)
+
+    def inc(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector(self)
+        now = time.time()
+        return {
+            "name": self.name,
+            "time": now,
+            "uptime_s": now - self.started,
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "histograms": {
+                name: h.as_dict() for name, h in list(self.histograms.items())
+            },
+        }
+
+
+class MetricsWriter:
+    def __init__(self, metrics, filename, interval):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self):
+        # write then rename so a scraper never sees a partial snapshot
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp_file = self.filename + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.metrics.snapshot(), f)
+            os.rename(tmp_file, self.filename)
+        except Exception:
+            logging.exception(f"Error writing metrics to {self.filename}")
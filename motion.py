@@ -3,113 +3,359 @@ import cv2
 import time
 import logging
 
+from background import MinBackground
+from slidingwindow import EncodedWindow, SlidingWindow
+from thermalconfig import CameraMotionConfig
+from tracker import Tracker
 
-class Background:
-    BACKGROUND_WEIGHT_ADD = 0.001
-    STILL_FOR = 200
-    # update pixels which have shown no movement for 200 frames
-    def __init__(self):
-        self.background = None
-        self.frames = 0
+FPS = 10
+WINDOW_SIZE = 5 * FPS
+# the most motion_count builds up to, so motion ends soon after it stops
+MAX_MOTION_COUNT = 30
+# frames scored together by detect_motion_batch, bounding its working memory
+BATCH_FRAMES = 256
 
-    def process_frame(self, frame):
-        self.frames += 1
-        if self.background is None:
-            self.background = frame.copy()
-            return
-        self.background = np.minimum(self.background, frame)
-
-
-class SlidingWindow:
-    def __init__(self, size):
-        # might not need lock
-        self.frame_len = size
-        self.frames = [None] * size
-        self.i = 0
-
-    def add(self, frame):
-        self.frames[self.i] = frame
-        self.i += 1
-        self.i = self.i % self.frame_len
-
-    @property
-    def oldest(self):
-        return self.frames[self.i]
-
-    def get_frames(self):
-        frames = []
-        cur = self.i
-        # end_index = (cur + 1) % self.frame_len
-        while len(frames) == 0 or cur != self.i:
-            frames.append(self.frames[cur])
-            cur = (cur + 1) % self.frame_len
-        return frames
 
+def scale_levels(scale):
+    levels = int(np.log2(scale))
+    if scale < 1 or 2**levels != scale:
+        raise ValueError(f"Scale must be a power of 2 got {scale}")
+    return levels
 
-FPS = 10
-WINDOW_SIZE = 5 * FPS
+
+def scale_kernel(size, scale):
+    size = max(1, round(size / scale))
+    return np.ones((size, size), "uint8")
+
+
+def erosion_counts(frames, gap, delta_thresh, kernels, block=BATCH_FRAMES):
+    # pixels left in each frame after thresholding its delta against the frame
+    # gap frames back and eroding with each kernel, 0 for the first gap frames.
+    # A block of frames is eroded as one tall image with rows of 1 between the
+    # frames, so a kernel never reaches into the next frame
+    count, height, width = frames.shape
+    pad = max(kernel.shape[0] for kernel in kernels)
+    counts = np.zeros((len(kernels), count), np.int64)
+    for start in range(gap, count, block):
+        end = min(start + block, count)
+        n = end - start
+        delta = cv2.absdiff(
+            frames[start - gap : end - gap].reshape(-1, width),
+            frames[start:end].reshape(-1, width),
+        )
+        binary = np.ones((n, height + pad, width), np.uint8)
+        np.greater(
+            delta.reshape(n, height, width), delta_thresh, out=binary[:, :height]
+        )
+        binary = binary.reshape(-1, width)
+        for i, kernel in enumerate(kernels):
+            # pixels are 0 or 1 so the sum of each frame counts them
+            eroded = cv2.erode(binary, kernel).reshape(n, -1)
+            counts[i, start:end] = eroded[:, : height * width].sum(1, np.int64)
+    return counts
+
+
+def detect_motion_batch(frames, config=None, block=BATCH_FRAMES):
+    # scores a (frames, height, width) grey stack, such as a memory mapped
+    # decode, returning the motion Motion.process_frame would give for each
+    # frame at scale 1 and the erosion pixels it was decided on. Idle mode and
+    # tracking change which frames are scored so need the streaming Motion
+    if config is None:
+        config = CameraMotionConfig.defaults_for("ir")
+    if frames.ndim != 3:
+        raise ValueError(f"Expected a (frames, height, width) stack got {frames.shape}")
+    if config.idle_secs or config.track_frames:
+        raise ValueError("Idle mode and tracking are not supported in batches")
+    gap = config.frame_compare_gap
+    kernels = [
+        scale_kernel(config.trigger_kernel, 1),
+        scale_kernel(config.recording_kernel, 1),
+    ]
+    if np.array_equal(kernels[0], kernels[1]):
+        kernels = kernels[:1]
+    counts = erosion_counts(frames, gap, config.delta_thresh, kernels, block)
+    trigger_pixels, recording_pixels = counts[0], counts[-1]
+
+    # which kernel applies depends on the motion so far, so only this pass over
+    # one count per frame is sequential
+    motion = np.zeros(len(frames), bool)
+    erosion_pixels = np.zeros(len(frames), np.int64)
+    moving = False
+    motion_count = 0
+    for i in range(gap, len(frames)):
+        pixels = recording_pixels[i] if moving else trigger_pixels[i]
+        if pixels >= config.count_thresh:
+            motion_count = min(motion_count + 1, MAX_MOTION_COUNT)
+        else:
+            motion_count = max(motion_count - 1, 0)
+        if not moving and motion_count >= config.trigger_frames:
+            moving = True
+        elif moving and motion_count <= 0:
+            moving = False
+        motion[i] = moving
+        erosion_pixels[i] = pixels
+    return motion, erosion_pixels
 
 
 class Motion:
-    def __init__(self):
+    # scale is a power of 2, when greater than 1 detection runs on a pyramid
+    # downscaled frame and full resolution is only used to confirm a trigger.
+    # When the config sets idle_secs a quiet scene drops to idle mode, which
+    # only checks some frames at low resolution until there is any motion
+    def __init__(self, background=None, scale=1, config=None):
+        self.levels = scale_levels(scale)
+        self.scale = scale
         self.preview_frames = SlidingWindow(WINDOW_SIZE)
-        self.preview_frames_grey = SlidingWindow(WINDOW_SIZE)
-
-        self.background = Background()
-        self.kernel_trigger = np.ones(
-            (15, 15), "uint8"
-        )  # kernel for erosion when not recording
-        self.kernel_recording = np.ones(
-            (10, 10), "uint8"
-        )  # kernel for erosion when recording
+        self.preview_frames_grey = None
+        self.preview_frames_small = None
+
+        if background is None:
+            background = MinBackground()
+        self.background = background
         self.motion = False
         self.motion_count = 0
+        self.erosion_pixels = 0
+        # pixels over delta_thresh before erosion
+        self.delta_pixels = 0
+        self.confirmed = 0
+        self.rejected = 0
         self.show = False
+        self.tracker = Tracker()
+        # tracks seen in the last frame
+        self.tracks = self.tracker.tracks
+        self.idle = False
+        self.idle_window = None
+        # frames since the last motion signal
+        self.quiet = 0
+        self.idle_skip = 0
+        self.wakes = 0
+        self.mode_secs = {"active": 0.0, "idle": 0.0}
+        self.mode_start = time.monotonic()
+        if config is None:
+            config = CameraMotionConfig.defaults_for("ir")
+        self.set_config(config)
 
-    def get_kernel(self):
-        if self.motion:
-            return self.kernel_recording
+    def set_config(self, config):
+        # safe to call between frames
+        self.config = config
+        self.delta_thresh = config.delta_thresh
+        self.count_thresh = config.count_thresh
+        self.trigger_frames = config.trigger_frames
+        self.track_frames = config.track_frames
+        # kernels for erosion when not recording and when recording
+        self.kernel_trigger = scale_kernel(config.trigger_kernel, 1)
+        self.kernel_recording = scale_kernel(config.recording_kernel, 1)
+        self.kernel_trigger_small = scale_kernel(config.trigger_kernel, self.scale)
+        self.kernel_recording_small = scale_kernel(config.recording_kernel, self.scale)
+        # motion is measured against the frame frame_compare_gap frames back
+        gap = config.frame_compare_gap
+        if (
+            self.preview_frames_grey is None
+            or self.preview_frames_grey.frame_len != gap
+        ):
+            self.preview_frames_grey = SlidingWindow(gap)
+            if self.scale > 1:
+                self.preview_frames_small = SlidingWindow(gap)
+        self.idle_frames = int(config.idle_secs * FPS)
+        self.idle_stride = max(1, config.idle_stride)
+        self.idle_scale = config.idle_scale
+        self.idle_levels = scale_levels(config.idle_scale)
+        self.kernel_idle = scale_kernel(config.trigger_kernel, config.idle_scale)
+        if self.idle:
+            self.set_idle(self.idle_frames > 0)
+
+    def set_preview_length(self, frames, quality=None):
+        # with a quality set the pre-roll is kept as JPEGs to save memory
+        if quality:
+            window = EncodedWindow(frames, quality)
         else:
-            return self.kernel_trigger
+            window = SlidingWindow(frames)
+        current = self.preview_frames
+        if (
+            frames != current.frame_len
+            or type(window) != type(current)
+            or (quality and window.params != current.params)
+        ):
+            self.preview_frames = window
 
-    # Processes a frame returning True if there is motion.
-    def process_frame(self, frame):
-        self.preview_frames.add(frame)
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        self.preview_frames_grey.add(frame)
+    def reset(self):
+        self.preview_frames.clear()
+        self.preview_frames_grey.clear()
+        if self.preview_frames_small is not None:
+            self.preview_frames_small.clear()
+        self.motion = False
+        self.motion_count = 0
+        self.erosion_pixels = 0
+        self.delta_pixels = 0
+        if self.idle:
+            self.set_idle(False)
+        self.quiet = 0
+        self.tracker.reset()
+        self.tracks = self.tracker.tracks
 
-        if self.preview_frames_grey.oldest is None:
-            return False
+    def set_idle(self, idle):
+        now = time.monotonic()
+        self.mode_secs["idle" if self.idle else "active"] += now - self.mode_start
+        self.mode_start = now
+        self.idle = idle
+        self.quiet = 0
+        self.idle_skip = 0
+        if idle:
+            # compare against a frame the same time back as in active mode
+            gap = max(1, self.config.frame_compare_gap // self.idle_stride)
+            self.idle_window = SlidingWindow(gap)
+            self.tracker.reset()
+            self.tracks = self.tracker.tracks
+        else:
+            self.idle_window = None
 
+    def mode_stats(self):
+        secs = dict(self.mode_secs)
+        secs["idle" if self.idle else "active"] += time.monotonic() - self.mode_start
+        return {
+            "idle": self.idle,
+            "active_secs": secs["active"],
+            "idle_secs": secs["idle"],
+            "wakes": self.wakes,
+        }
+
+    def tracked(self):
+        # with track_frames set a trigger also needs an object that has been
+        # followed for that many frames, so flicker does not trigger
+        if not self.track_frames:
+            return True
+        return len(self.tracks) > 0 and self.tracks["age"].max() >= self.track_frames
+
+    def get_background(self):
+        return self.background.background
+
+    def get_kernel(self, small=False):
+        if self.motion:
+            return self.kernel_recording_small if small else self.kernel_recording
+        else:
+            return self.kernel_trigger_small if small else self.kernel_trigger
+
+    def downscale(self, frame, levels=None):
+        if levels is None:
+            levels = self.levels
+        for _ in range(levels):
+            frame = cv2.pyrDown(frame)
+        return frame
+
+    def detect(self, oldest, frame, kernel):
         # Filter and get diff from background
         delta = cv2.absdiff(
-            self.preview_frames_grey.oldest, frame
+            oldest, frame
         )  # Get delta from current frame and background
-        threshold = cv2.threshold(delta, 25, 255, cv2.THRESH_BINARY)[1]
+        threshold = cv2.threshold(delta, self.delta_thresh, 255, cv2.THRESH_BINARY)[1]
+        erosion_image = cv2.erode(threshold, kernel)
+        return delta, threshold, erosion_image, cv2.countNonZero(erosion_image)
 
-        erosion_image = cv2.erode(threshold, self.get_kernel())
-        erosion_pixels = len(erosion_image[erosion_image > 0])
-        # to do find a value that suites the number of pixesl we want to move
+    def add_grey(self, frame, small):
         self.preview_frames_grey.add(frame)
+        if small is not None:
+            self.preview_frames_small.add(small)
+
+    def idle_motion(self, frame):
+        # cheap check on a downscaled frame, any motion goes straight back to
+        # active mode so this frame is also checked at full resolution
+        small = self.downscale(frame, self.idle_levels)
+        oldest = self.idle_window.oldest
+        erosion_pixels = 0
+        if oldest is not None:
+            erosion_pixels = self.detect(oldest, small, self.kernel_idle)[3]
+        self.idle_window.add(small)
+        if erosion_pixels > 0:
+            self.wakes += 1
+            self.set_idle(False)
+            return True
+        self.erosion_pixels = 0
+        self.delta_pixels = 0
+        self.add_grey(frame, self.downscale(frame) if self.scale > 1 else None)
+        self.background.process_frame(frame)
+        return False
+
+    # Processes a BGR or grey frame returning True if there is motion.
+    def process_frame(self, frame):
+        # the pre-roll gets every frame whatever the mode
+        self.preview_frames.add(frame)
+        if self.idle:
+            self.idle_skip = (self.idle_skip + 1) % self.idle_stride
+            if self.idle_skip:
+                return False
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.idle and not self.idle_motion(frame):
+            return False
+        small = None
+        if self.scale > 1:
+            small = self.downscale(frame)
+
+        oldest = self.preview_frames_grey.oldest
+        if oldest is None:
+            self.add_grey(frame, small)
+            return False
+
+        erosion_scale = 1
+        if small is None:
+            delta, threshold, erosion_image, erosion_pixels = self.detect(
+                oldest, frame, self.get_kernel()
+            )
+        else:
+            erosion_scale = self.scale
+            delta, threshold, erosion_image, erosion_pixels = self.detect(
+                self.preview_frames_small.oldest, small, self.get_kernel(small=True)
+            )
+            erosion_pixels *= self.scale * self.scale
+            if erosion_pixels >= self.count_thresh and not self.motion:
+                # only let the full resolution frame count towards a trigger
+                delta, threshold, erosion_image, erosion_pixels = self.detect(
+                    oldest, frame, self.get_kernel()
+                )
+                erosion_scale = 1
+                if erosion_pixels >= self.count_thresh:
+                    self.confirmed += 1
+                else:
+                    self.rejected += 1
+        self.erosion_pixels = erosion_pixels
+        self.delta_pixels = cv2.countNonZero(threshold) * erosion_scale * erosion_scale
+        self.tracks = self.tracker.update(
+            erosion_image if erosion_pixels else None, erosion_scale
+        )
+        # to do find a value that suites the number of pixesl we want to move
+        self.add_grey(frame, small)
         self.background.process_frame(frame)
 
         # Calculate if there was motion in the current frame
         # TODO Chenage how much ioldests added to the motion_count depending on how big the motion is
-        if erosion_pixels > 0:
+        if erosion_pixels >= self.count_thresh:
             self.motion_count += 1
-            self.motion_count = min(self.motion_count, 30)
+            self.motion_count = min(self.motion_count, MAX_MOTION_COUNT)
         else:
             self.motion_count -= 1
             self.motion_count = max(self.motion_count, 0)
 
         # logging.info("motion count is %s", self.motion_count)
         # Check if motion has started or ended
-        if not self.motion and self.motion_count > 10:
+        if (
+            not self.motion
+            and self.motion_count >= self.trigger_frames
+            and self.tracked()
+        ):
             self.motion = True
 
         elif self.motion and self.motion_count <= 0:
             self.motion = False
 
+        if self.idle_frames:
+            if self.motion or self.motion_count or erosion_pixels:
+                self.quiet = 0
+            else:
+                self.quiet += 1
+                if self.quiet >= self.idle_frames:
+                    logging.info("No motion, detecting at a reduced rate")
+                    self.set_idle(True)
+
         if self.show:
             cv2.imshow("window", frame)
             cv2.imshow("delta", delta)
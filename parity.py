@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+""" Compare trigger decisions of the multi resolution motion detection, and
+optionally the batched detection, against the full resolution path over a set
+of clips
+"""
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from logs import init_logging
+from motion import Motion, detect_motion_batch
+
+VIDEO_EXTS = [".mp4", ".avi"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "source", nargs="+", help="clips, or folders to search for clips"
+    )
+    parser.add_argument(
+        "--scale", type=int, default=2, help="downscale factor, a power of 2"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="also score each clip with the batched detection",
+    )
+    parser.add_argument("--output", help="write the report as json to this file")
+    return parser.parse_args()
+
+
+def find_clips(sources):
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            for ext in VIDEO_EXTS:
+                yield from sorted(source.rglob(f"*{ext}"))
+        else:
+            yield source
+
+
+def trigger_starts(decisions):
+    return [
+        i
+        for i, motion in enumerate(decisions)
+        if motion and (i == 0 or not decisions[i - 1])
+    ]
+
+
+def compare_clip(clip, scale, batch=False):
+    detectors = {"full": Motion(), "scaled": Motion(scale=scale)}
+    decisions = {name: [] for name in detectors}
+    times = {name: 0.0 for name in detectors}
+    grey = []
+    cap = cv2.VideoCapture(str(clip))
+    while True:
+        returned, frame = cap.read()
+        if not returned:
+            break
+        if batch:
+            grey.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        for name, detector in detectors.items():
+            start = time.perf_counter()
+            decisions[name].append(detector.process_frame(frame))
+            times[name] += time.perf_counter() - start
+    cap.release()
+    if batch and grey:
+        start = time.perf_counter()
+        decisions["batch"] = detect_motion_batch(np.stack(grey))[0].tolist()
+        times["batch"] = time.perf_counter() - start
+
+    frames = len(decisions["full"])
+    agree = sum(a == b for a, b in zip(decisions["full"], decisions["scaled"]))
+    full_starts = trigger_starts(decisions["full"])
+    scaled_starts = trigger_starts(decisions["scaled"])
+    result = {
+        "clip": str(clip),
+        "frames": frames,
+        "agreement": agree / frames if frames else 1.0,
+        "full_triggers": full_starts,
+        "scaled_triggers": scaled_starts,
+        "same_triggers": full_starts == scaled_starts,
+        "full_ms_per_frame": 1000 * times["full"] / max(frames, 1),
+        "scaled_ms_per_frame": 1000 * times["scaled"] / max(frames, 1),
+        "confirmed": detectors["scaled"].confirmed,
+        "rejected": detectors["scaled"].rejected,
+    }
+    if "batch" in decisions:
+        result["batch_triggers"] = trigger_starts(decisions["batch"])
+        result["same_batch_triggers"] = decisions["batch"] == decisions["full"]
+        result["batch_ms_per_frame"] = 1000 * times["batch"] / max(frames, 1)
+    return result
+
+
+def main():
+    init_logging()
+    args = parse_args()
+    results = []
+    for clip in find_clips(args.source):
+        result = compare_clip(clip, args.scale, args.batch)
+        logging.info(
+            f"{clip} agreement {result['agreement']:.3f} triggers full "
+            f"{result['full_triggers']} scaled {result['scaled_triggers']}, "
+            f"{result['full_ms_per_frame']:.1f}ms vs "
+            f"{result['scaled_ms_per_frame']:.1f}ms per frame"
+        )
+        if "batch_triggers" in result:
+            logging.info(
+                f"{clip} batch triggers {result['batch_triggers']}, "
+                f"{result['batch_ms_per_frame']:.1f}ms per frame"
+            )
+        results.append(result)
+
+    mismatched = [r["clip"] for r in results if not r["same_triggers"]]
+    frames = sum(r["frames"] for r in results)
+    summary = {
+        "scale": args.scale,
+        "clips": len(results),
+        "frames": frames,
+        "agreement": sum(r["agreement"] * r["frames"] for r in results)
+        / max(frames, 1),
+        "mismatched_clips": mismatched,
+    }
+    if args.batch:
+        summary["batch_mismatched_clips"] = [
+            r["clip"] for r in results if not r.get("same_batch_triggers", True)
+        ]
+    logging.info(
+        f"{summary['clips']} clips, {len(mismatched)} with different triggers, "
+        f"frame agreement {summary['agreement']:.3f}"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "clips": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
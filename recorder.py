@@ -1,6 +1,7 @@
 import os
 import cv2
 from logs import init_logging
+from motion import Motion
 from datetime import datetime
 import socket
 import logging
@@ -56,7 +57,7 @@ class Recorder:
             self.recording = False
 
     def process_frame(self, frame):
-        motion = self.motion_detector.process_frame(frame.copy())
+        motion = self.motion_detector.process_frame(frame)
 
         if not self.recording and motion:
             self.length = 0
@@ -85,127 +86,3 @@ class Recorder:
         date_str = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
         file_name = f"{date_str}_{HOSTNAME}.avi"
         return os.path.join(VIDEO_DIR, file_name)
-
-
-class Background:
-    BACKGROUND_WEIGHT_ADD = 0.001
-    STILL_FOR = 200
-    # update pixels which have shown no movement for 200 frames
-    def __init__(self):
-        self.background = None
-        self.frames = 0
-
-    def process_frame(self, frame):
-        self.frames += 1
-        if self.background is None:
-            self.background = frame.copy()
-            return
-        self.background = np.minimum(self.background, frame)
-
-
-class SlidingWindow:
-    def __init__(self, size):
-        # might not need lock
-        self.frame_len = size
-        self.frames = [None] * size
-        self.i = 0
-
-    def add(self, frame):
-        self.frames[self.i] = frame
-        self.i += 1
-        self.i = self.i % self.frame_len
-
-    @property
-    def oldest(self):
-        return self.frames[self.i]
-
-    def get_frames(self):
-        frames = []
-        cur = self.i
-        # end_index = (cur + 1) % self.frame_len
-        while len(frames) == 0 or cur != self.i:
-            frames.append(self.frames[cur])
-            cur = (cur + 1) % self.frame_len
-        return frames
-
-
-FPS = 10
-WINDOW_SIZE = 5 * FPS
-
-
-class Motion:
-    def __init__(self):
-        self.preview_frames = SlidingWindow(WINDOW_SIZE)
-        self.preview_frames_grey = SlidingWindow(WINDOW_SIZE)
-
-        self.background = Background()
-        self.kernel_trigger = np.ones(
-            (15, 15), "uint8"
-        )  # kernel for erosion when not recording
-        self.kernel_recording = np.ones(
-            (10, 10), "uint8"
-        )  # kernel for erosion when recording
-        self.motion = False
-        self.motion_count = 0
-        self.show = False
-
-    def get_kernel(self):
-        if self.motion:
-            return self.kernel_recording
-        else:
-            return self.kernel_trigger
-
-    # Processes a frame returning True if there is motion.
-    def process_frame(self, frame):
-        self.preview_frames.add(frame)
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        self.preview_frames_grey.add(frame)
-
-        if self.preview_frames_grey.oldest is None:
-            return False
-
-        # Filter and get diff from background
-        delta = cv2.absdiff(
-            self.preview_frames_grey.oldest, frame
-        )  # Get delta from current frame and background
-        threshold = cv2.threshold(delta, 25, 255, cv2.THRESH_BINARY)[1]
-
-        erosion_image = cv2.erode(threshold, self.get_kernel())
-        erosion_pixels = len(erosion_image[erosion_image > 0])
-        # to do find a value that suites the number of pixesl we want to move
-        self.preview_frames_grey.add(frame)
-        self.background.process_frame(frame)
-
-        # Calculate if there was motion in the current frame
-        # TODO Chenage how much ioldests added to the motion_count depending on how big the motion is
-        if erosion_pixels > 0:
-            self.motion_count += 1
-            self.motion_count = min(self.motion_count, 30)
-        else:
-            self.motion_count -= 1
-            self.motion_count = max(self.motion_count, 0)
-
-        # logging.info("motion count is %s", self.motion_count)
-        # Check if motion has started or ended
-        if not self.motion and self.motion_count > 10:
-            self.motion = True
-
-        elif self.motion and self.motion_count <= 0:
-            self.motion = False
-
-        if self.show:
-            cv2.imshow("window", frame)
-            cv2.imshow("delta", delta)
-            cv2.imshow("threshold", threshold)
-            cv2.imshow("erosion_image", erosion_image)
-            cv2.imshow("background", self.background.background)
-
-            cv2.moveWindow(f"window", 0, 0)
-            cv2.moveWindow(f"delta", 640, 0)
-            cv2.moveWindow(f"erosion_image", 0, 480)
-            cv2.moveWindow(f"threshold", 640, 480)
-            cv2.moveWindow(f"background", 1000, 960)
-
-            cv2.waitKey(1)
-
-        return self.motion
@@ -0,0 +1,69 @@
+""" Precomputes when a TimeWindow next opens and closes, including sunrise and
+sunset offsets, so the pipeline can sleep until the next transition instead of
+checking the window every frame
+"""
+import logging
+from datetime import datetime, time, timedelta
+
+
+class WindowScheduler:
+    def __init__(self, window):
+        self.window = window
+        self.always_open = (window.start.any_time and window.end.any_time) or (
+            not window.use_sunrise_sunset() and window.start.time == window.end.time
+        )
+
+    def sun_times(self, date):
+        try:
+            sun = self.window.location.sun(date=date, local=True)
+        except Exception:
+            # the sun may not rise or set at high latitudes
+            logging.exception(f"Could not calculate sun times for {date}")
+            return None
+        # astral gives aware times in the location's timezone, use local time
+        return {
+            key: sun[key].astimezone().replace(tzinfo=None)
+            for key in ("sunrise", "sunset")
+        }
+
+    def boundary(self, rel_time, date, sun_key):
+        if rel_time.any_time:
+            return None
+        if rel_time.is_relative:
+            sun = self.sun_times(date)
+            if sun is None:
+                return None
+            return sun[sun_key] + timedelta(seconds=rel_time.offset_s)
+        return datetime.combine(date, rel_time.time)
+
+    def interval(self, date):
+        # the window opening on date, as (open, close) datetimes
+        start = self.boundary(self.window.start, date, "sunset")
+        if start is None:
+            start = datetime.combine(date, time())
+        end = self.boundary(self.window.end, date, "sunrise")
+        if end is None:
+            end = datetime.combine(date + timedelta(days=1), time())
+        if end <= start:
+            end = self.boundary(self.window.end, date + timedelta(days=1), "sunrise")
+            if end is None:
+                end = datetime.combine(date + timedelta(days=2), time())
+        return start, end
+
+    def next_transition(self, now=None):
+        # returns whether now is inside the window and when that next changes,
+        # None if the window never closes
+        if self.always_open:
+            return True, None
+        if self.window.use_sunrise_sunset() and self.window.location is None:
+            raise ValueError(
+                "Location must be set for relative times, by calling set_location"
+            )
+        if now is None:
+            now = datetime.now()
+        today = now.date()
+        intervals = [self.interval(today + timedelta(days=d)) for d in range(-1, 3)]
+        for start, end in intervals:
+            if start <= now < end:
+                return True, end
+        return False, min(start for start, _ in intervals if start > now)
@@ -0,0 +1,115 @@
+""" A fixed size ring of frames backed by one contiguous numpy array, frames
+are copied in place so adding a frame never allocates
+"""
+import cv2
+import numpy as np
+
+
+class SlidingWindow:
+    def __init__(self, size, shape=None, dtype=np.uint8):
+        self.frame_len = size
+        self.frames = None
+        self.i = 0
+        self.count = 0
+        if shape is not None:
+            self.allocate(shape, dtype)
+
+    def allocate(self, shape, dtype=np.uint8):
+        self.frames = np.empty((self.frame_len,) + tuple(shape), dtype=dtype)
+
+    def add(self, frame):
+        if self.frames is None:
+            self.allocate(frame.shape, frame.dtype)
+        np.copyto(self.frames[self.i], frame)
+        self.i = (self.i + 1) % self.frame_len
+        self.count = min(self.count + 1, self.frame_len)
+
+    def clear(self):
+        # keeps the allocated frames
+        self.i = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return 0 if self.frames is None else self.frames.nbytes
+
+    @property
+    def full(self):
+        return self.count == self.frame_len
+
+    @property
+    def oldest(self):
+        # None until the window has filled, matching the old list behaviour
+        if not self.full:
+            return None
+        return self.frames[self.i]
+
+    @property
+    def newest(self):
+        if self.count == 0:
+            return None
+        return self.frames[self.i - 1]
+
+    def get_slices(self):
+        # two views which together hold every frame from oldest to newest
+        if self.count == 0:
+            return ()
+        if not self.full:
+            return (self.frames[: self.i],)
+        return (self.frames[self.i :], self.frames[: self.i])
+
+    def get_frames(self):
+        # frames are views into the window, so must be used before the next add
+        for block in self.get_slices():
+            yield from block
+
+
+class EncodedWindow:
+    # the same ring as SlidingWindow but frames are stored as JPEGs, trading an
+    # encode per frame for a fraction of the memory
+    def __init__(self, size, quality=90):
+        self.frame_len = size
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.frames = [None] * size
+        self.i = 0
+        self.count = 0
+
+    def add(self, frame):
+        self.frames[self.i] = cv2.imencode(".jpg", frame, self.params)[1]
+        self.i = (self.i + 1) % self.frame_len
+        self.count = min(self.count + 1, self.frame_len)
+
+    def clear(self):
+        self.frames = [None] * self.frame_len
+        self.i = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return sum(len(data) for data in self.frames if data is not None)
+
+    @property
+    def full(self):
+        return self.count == self.frame_len
+
+    @property
+    def newest(self):
+        if self.count == 0:
+            return None
+        return cv2.imdecode(self.frames[self.i - 1], cv2.IMREAD_UNCHANGED)
+
+    def get_encoded(self):
+        # JPEG buffers from oldest to newest, never modified once added
+        if not self.full:
+            return self.frames[: self.i]
+        return self.frames[self.i :] + self.frames[: self.i]
+
+    def get_frames(self):
+        for data in self.get_encoded():
+            yield cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
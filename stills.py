@@ -0,0 +1,116 @@
+""" Encodes stills and thumbnails on a background thread and publishes them
+with an atomic rename, so triggers never wait on an image encode and readers
+never see a half written file
+"""
+import collections
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+import cv2
+
+STILL_EXT = "jpg"
+STILL_QUALITY = 85
+THUMBNAIL_WIDTH = 160
+# stills are kept for this many of the most recent clips
+KEEP_CLIPS = 20
+ENCODE_PARAMS = {
+    "jpg": cv2.IMWRITE_JPEG_QUALITY,
+    "webp": cv2.IMWRITE_WEBP_QUALITY,
+}
+
+
+class StillWriter:
+    def __init__(
+        self,
+        still_dir,
+        ext=STILL_EXT,
+        quality=STILL_QUALITY,
+        thumbnail_width=THUMBNAIL_WIDTH,
+        keep_clips=KEEP_CLIPS,
+        max_queue=8,
+        metrics=None,
+    ):
+        if ext not in ENCODE_PARAMS:
+            raise ValueError(f"Unknown still format {ext}")
+        self.still_dir = still_dir
+        self.ext = ext
+        self.params = [ENCODE_PARAMS[ext], quality]
+        self.thumbnail_width = thumbnail_width
+        self.keep_clips = keep_clips
+        self.metrics = metrics
+        # each clip's stills are kept in a folder named after the clip
+        self.clips_dir = os.path.join(still_dir, "stills")
+        os.makedirs(self.clips_dir, exist_ok=True)
+        with os.scandir(self.clips_dir) as entries:
+            folders = [entry for entry in entries if entry.is_dir()]
+        folders.sort(key=lambda entry: entry.stat().st_mtime)
+        self.clips = collections.deque(entry.path for entry in folders)
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame, name, clip=None):
+        # saves frame as name, in the clip's folder if given, never blocks
+        try:
+            self.queue.put_nowait((frame.copy(), name, clip))
+        except queue.Full:
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.inc("stills_dropped")
+            return False
+        return True
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def get_clip_dir(self, clip):
+        return os.path.join(self.clips_dir, clip)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.save(*item)
+            except Exception:
+                logging.exception("Error saving still")
+
+    def save(self, frame, name, clip):
+        start = time.perf_counter()
+        folder = self.still_dir
+        if clip is not None:
+            folder = self.add_clip(clip)
+        self.publish(os.path.join(folder, f"{name}.{self.ext}"), frame)
+        height, width = frame.shape[:2]
+        if width > self.thumbnail_width:
+            size = (self.thumbnail_width, height * self.thumbnail_width // width)
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        self.publish(os.path.join(folder, f"{name}_thumb.{self.ext}"), frame)
+        if self.metrics is not None:
+            self.metrics.observe("still", (time.perf_counter() - start) * 1000)
+
+    def add_clip(self, clip):
+        folder = self.get_clip_dir(clip)
+        if folder not in self.clips:
+            os.makedirs(folder, exist_ok=True)
+            self.clips.append(folder)
+            while len(self.clips) > self.keep_clips:
+                shutil.rmtree(self.clips.popleft(), ignore_errors=True)
+        return folder
+
+    def publish(self, filename, frame):
+        returned, data = cv2.imencode(f".{self.ext}", frame, self.params)
+        if not returned:
+            raise ValueError(f"Could not encode {filename}")
+        folder, name = os.path.split(filename)
+        tmp_file = os.path.join(folder, f".{name}.tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+        os.replace(tmp_file, filename)
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+""" Runs an independent capture, detect and record pipeline for each camera,
+restarting any pipeline that stops without touching the others
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from main import (
+    METRICS_DIR,
+    METRICS_INTERVAL,
+    init_logging,
+    is_camera,
+    run_pipeline,
+)
+from metrics import Metrics, MetricsWriter
+
+# seconds to wait before restarting a pipeline, doubled each time it fails
+# again until it has run for HEALTHY_SECS
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 5 * 60
+HEALTHY_SECS = 10 * 60
+# seconds a pipeline has to finish its clip once asked to stop
+STOP_TIMEOUT = 30
+
+
+def parse_source(value):
+    return int(value) if value.isdigit() else value
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run a recording pipeline for each camera"
+    )
+    parser.add_argument(
+        "--camera",
+        action="append",
+        required=True,
+        metavar="NAME=SOURCE",
+        help="a camera index, device or file to record as NAME, may be given more than once",
+    )
+    parser.add_argument(
+        "--cpus",
+        action="append",
+        default=[],
+        metavar="NAME=CPU,CPU",
+        help="only run the pipeline for NAME on these cpus",
+    )
+    parser.add_argument(
+        "--luma",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="capture and record grey frames for NAME",
+    )
+    args = parser.parse_args()
+    cameras = {}
+    for camera in args.camera:
+        name, _, source = camera.partition("=")
+        if not name or not source:
+            parser.error(f"Camera should be NAME=SOURCE got {camera}")
+        cameras[name] = parse_source(source)
+    cpus = {}
+    for value in args.cpus:
+        name, _, cpu_list = value.partition("=")
+        cpus[name] = {int(cpu) for cpu in cpu_list.split(",")}
+    for name in list(cpus) + args.luma:
+        if name not in cameras:
+            parser.error(f"Unknown camera {name}")
+    return cameras, cpus, set(args.luma)
+
+
+def run(name, source, luma, cpus):
+    init_logging()
+    sys.exit(run_pipeline(source, luma, name, cpus))
+
+
+class Pipeline:
+    def __init__(self, name, source, luma=False, cpus=None):
+        self.name = name
+        self.source = source
+        self.luma = luma
+        self.cpus = cpus
+        self.process = None
+        self.started = None
+        self.restart_at = None
+        self.delay = RESTART_DELAY
+        self.restarts = 0
+        self.finished = False
+
+    def start(self):
+        logging.info(f"Starting pipeline {self.name} for {self.source}")
+        self.process = multiprocessing.Process(
+            target=run,
+            args=(self.name, self.source, self.luma, self.cpus),
+            name=f"pipeline-{self.name}",
+        )
+        self.process.start()
+        self.started = time.monotonic()
+
+    def check(self):
+        # restarts the pipeline once it has stopped, backing off if it keeps
+        # failing, a file that was recorded to the end is left finished
+        if self.finished or self.process.is_alive():
+            return
+        now = time.monotonic()
+        if self.restart_at is None:
+            exitcode = self.process.exitcode
+            if exitcode == 0 and not is_camera(self.source):
+                logging.info(f"Pipeline {self.name} finished")
+                self.finished = True
+                return
+            if now - self.started > HEALTHY_SECS:
+                self.delay = RESTART_DELAY
+            logging.error(
+                f"Pipeline {self.name} stopped with {exitcode}, restarting in {self.delay}s"
+            )
+            self.restart_at = now + self.delay
+            self.delay = min(self.delay * 2, MAX_RESTART_DELAY)
+        elif now >= self.restart_at:
+            self.restart_at = None
+            self.restarts += 1
+            self.start()
+
+    def stop(self):
+        if self.process is None or not self.process.is_alive():
+            return
+        # the pipeline finishes its clip on SIGTERM
+        self.process.terminate()
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            logging.error(f"Pipeline {self.name} did not stop, killing it")
+            self.process.kill()
+            self.process.join()
+
+
+def main():
+    init_logging()
+    cameras, cpus, luma = parse_args()
+    pipelines = [
+        Pipeline(name, source, name in luma, cpus.get(name))
+        for name, source in cameras.items()
+    ]
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    metrics = Metrics("supervisor")
+
+    def collect_metrics(m):
+        for pipeline in pipelines:
+            m.set(f"{pipeline.name}_restarts", pipeline.restarts)
+            alive = pipeline.process is not None and pipeline.process.is_alive()
+            m.set(f"{pipeline.name}_running", alive)
+
+    metrics.add_collector(collect_metrics)
+    metrics_writer = MetricsWriter(
+        metrics, os.path.join(METRICS_DIR, "supervisor.json"), METRICS_INTERVAL
+    )
+    metrics_writer.start()
+    for pipeline in pipelines:
+        pipeline.start()
+    try:
+        while not stopping.wait(1):
+            for pipeline in pipelines:
+                pipeline.check()
+            if all(pipeline.finished for pipeline in pipelines):
+                break
+    except KeyboardInterrupt:
+        pass
+    logging.info("Stopping pipelines")
+    for pipeline in pipelines:
+        pipeline.stop()
+    metrics_writer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+""" Per frame motion telemetry for each clip, kept in preallocated numpy blocks
+while recording and saved next to the clip as a compressed .npz once the clip
+is in the spool, so motion does not need to be analysed again
+"""
+import os
+
+import numpy as np
+
+TELEMETRY_EXT = ".npz"
+# one row per frame, recorded is False for frames the encoder dropped
+TELEMETRY_DTYPE = np.dtype(
+    [
+        ("frame", np.uint32),
+        ("time", np.float64),
+        ("delta_pixels", np.uint32),
+        ("erosion_pixels", np.uint32),
+        ("motion_count", np.uint8),
+        ("motion", np.bool_),
+        ("idle", np.bool_),
+        ("detect_ms", np.float32),
+        ("recorded", np.bool_),
+    ]
+)
+BLOCK_ROWS = 256
+
+
+def telemetry_file(clip_file):
+    return os.path.splitext(clip_file)[0] + TELEMETRY_EXT
+
+
+def save_telemetry(filename, rows, fps):
+    # rows are for the clip's frames after the background frame
+    folder, name = os.path.split(filename)
+    tmp_file = os.path.join(folder, f".{name}.tmp")
+    with open(tmp_file, "wb") as f:
+        np.savez_compressed(f, rows=rows, fps=fps)
+    os.replace(tmp_file, filename)
+
+
+def load_telemetry(filename):
+    with np.load(filename) as data:
+        return data["rows"]
+
+
+class TelemetryRing:
+    # rows for the last size frames, so the pre-roll has telemetry too
+    def __init__(self, size):
+        self.rows = np.zeros(size, TELEMETRY_DTYPE)
+        self.i = 0
+        self.count = 0
+
+    @property
+    def size(self):
+        return len(self.rows)
+
+    def add(self, row):
+        self.rows[self.i] = row
+        self.i = (self.i + 1) % len(self.rows)
+        self.count = min(self.count + 1, len(self.rows))
+
+    def newest(self, count):
+        # a copy of the last count rows, oldest first
+        count = min(count, self.count)
+        start = (self.i - count) % len(self.rows)
+        if start + count <= len(self.rows):
+            return self.rows[start : start + count].copy()
+        return np.concatenate((self.rows[start:], self.rows[: self.i]))
+
+
+class ClipTelemetry:
+    # rows for every frame of a clip, blocks are kept between clips so adding
+    # a row only allocates when a clip is longer than any before it
+    def __init__(self, block_rows=BLOCK_ROWS):
+        self.block_rows = block_rows
+        self.blocks = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def add(self, row):
+        block, i = divmod(self.count, self.block_rows)
+        if block == len(self.blocks):
+            self.blocks.append(np.zeros(self.block_rows, TELEMETRY_DTYPE))
+        self.blocks[block][i] = row
+        self.count += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def get_rows(self):
+        # a copy, so the blocks can be reused for the next clip
+        if not self.count:
+            return np.zeros(0, TELEMETRY_DTYPE)
+        used = -(-self.count // self.block_rows)
+        return np.concatenate(self.blocks[:used])[: self.count]
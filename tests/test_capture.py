@@ -0,0 +1,41 @@
+import cv2
+
+from capture import LUMA_FORMATS, request_luma
+
+
+class FakeCapture:
+    # a camera that only accepts the given formats
+    def __init__(self, formats=()):
+        self.formats = [cv2.VideoWriter_fourcc(*name) for name in formats]
+        self.props = {
+            cv2.CAP_PROP_CONVERT_RGB: 1,
+            cv2.CAP_PROP_FOURCC: cv2.VideoWriter_fourcc(*"MJPG"),
+        }
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FOURCC and value not in self.formats:
+            return False
+        self.props[prop] = value
+        return True
+
+    def get(self, prop):
+        return self.props[prop]
+
+
+def test_request_luma_keeps_raw_frames():
+    cap = FakeCapture(["YUYV"])
+    assert request_luma(cap) == "YUYV"
+    assert cap.get(cv2.CAP_PROP_CONVERT_RGB) == 0
+
+
+def test_request_luma_rejected_converts_to_bgr():
+    cap = FakeCapture()
+    assert request_luma(cap) is None
+    # frames must arrive as BGR for the grey conversion fallback
+    assert cap.get(cv2.CAP_PROP_CONVERT_RGB) == 1
+    assert cap.get(cv2.CAP_PROP_FOURCC) == cv2.VideoWriter_fourcc(*"MJPG")
+
+
+def test_request_luma_prefers_grey():
+    cap = FakeCapture(LUMA_FORMATS)
+    assert request_luma(cap) == LUMA_FORMATS[0]
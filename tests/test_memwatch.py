@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from benchmark import NullEncoder, synthetic_frames
+from framering import FrameRing
+from main import MEMORY_HEADROOM_MB, Recorder
+from memwatch import CLOSE_CLIP, NORMAL, RESTART, SHED_PREVIEW, MemoryWatchdog
+from motion import WINDOW_SIZE
+
+RING_MB = 64
+
+
+def touch_ring(ring, ready, done):
+    # reads every page so they are mapped in this process too
+    int(ring.frames.sum())
+    ready.set()
+    done.wait()
+
+
+def test_shared_frame_ring_counted_once(tmp_path):
+    ring = FrameRing((RING_MB, 1024, 1024), slots=1)
+    ring.frames.fill(1)
+    ready = multiprocessing.Event()
+    done = multiprocessing.Event()
+    p = multiprocessing.Process(target=touch_ring, args=(ring, ready, done))
+    p.start()
+    try:
+        ready.wait()
+        watchdog = MemoryWatchdog(
+            tmp_path / "memory.jsonl",
+            MEMORY_HEADROOM_MB,
+            processes={"capture": os.getpid(), "recorder": p.pid},
+        )
+        memory = watchdog.get_memory()
+        rss = sum(process.memory_info().rss for process in watchdog.processes.values())
+        # rss counts the ring in both processes, pss splits it between them
+        assert sum(memory.values()) < rss / 1024 / 1024 - RING_MB * 0.75
+    finally:
+        done.set()
+        p.join()
+        ring.unlink()
+
+
+def test_levels_step_up_and_down(tmp_path):
+    watchdog = MemoryWatchdog(tmp_path / "memory.jsonl", (100, 200, 300))
+    assert watchdog.get_level(100) == NORMAL
+    assert watchdog.limits_mb == [200, 300, 400]
+    watchdog.level = watchdog.get_level(310)
+    assert watchdog.level == CLOSE_CLIP
+    # under the limit but not by enough to step down
+    assert watchdog.get_level(290) == CLOSE_CLIP
+    watchdog.level = watchdog.get_level(250)
+    assert watchdog.level == SHED_PREVIEW
+    watchdog.level = watchdog.get_level(100)
+    assert watchdog.level == NORMAL
+
+
+def test_steady_state_stays_normal(tmp_path):
+    # a recorder with a full pre-roll recording moving blobs should not grow
+    # anywhere near the first level
+    frames = synthetic_frames("blobs", (640, 480), 60)
+    r = Recorder(640, 480, video_dir=tmp_path, tmp_dir=tmp_path, still_dir=tmp_path)
+    r.encoder.stop()
+    r.encoder = NullEncoder()
+    watchdog = MemoryWatchdog(tmp_path / "memory.jsonl", MEMORY_HEADROOM_MB)
+    for i in range(WINDOW_SIZE + 10):
+        r.process_frame(frames[i % len(frames)])
+    watchdog.sample()
+    for i in range(600):
+        r.process_frame(frames[i % len(frames)])
+    record = watchdog.sample()
+    r.close()
+    assert r.metrics.counters["triggers"] > 0
+    assert record["level"] == NORMAL
+    assert record["total_mb"] - record["baseline_mb"] < MEMORY_HEADROOM_MB[0] / 2
+    assert np.isfinite(record["total_mb"])
+
+
+class FakeWatchdog:
+    level = NORMAL
+
+
+class ClosingEncoder(NullEncoder):
+    def __init__(self):
+        self.closed = []
+
+    def close(self, filename, out_file=None, info=None):
+        self.closed.append(info)
+
+
+@pytest.mark.parametrize("level", [CLOSE_CLIP, RESTART])
+def test_level_jump_closes_clip(tmp_path, level):
+    # a level can jump straight past SHED_PREVIEW while recording
+    frames = synthetic_frames("blobs", (640, 480), 60)
+    watchdog = FakeWatchdog()
+    r = Recorder(
+        640,
+        480,
+        video_dir=tmp_path,
+        tmp_dir=tmp_path,
+        still_dir=tmp_path,
+        memory_watchdog=watchdog,
+    )
+    r.encoder.stop()
+    r.encoder = ClosingEncoder()
+    i = 0
+    while not r.recording:
+        r.process_frame(frames[i % len(frames)])
+        i += 1
+    watchdog.level = level
+    r.process_frame(frames[i % len(frames)])
+    r.close()
+    assert not r.recording
+    assert r.memory_level == level
+    assert [clip["stop_reason"] for clip in r.encoder.closed] == ["memory"]
+    assert os.path.exists(os.path.join(r.encoder.closed[0]["stills"], "last.jpg"))
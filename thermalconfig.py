@@ -8,6 +8,8 @@ from timewindow import RelAbsTime, TimeWindow
 
 CONFIG_FILENAME = "config.toml"
 CONFIG_DIRS = [Path(__file__).parent.parent, Path("/etc/cacophony")]
+# the encoder backends make_writer knows
+ENCODER_BACKENDS = ["opencv", "ffmpeg"]
 
 
 class LockSafeConfig:
@@ -70,10 +72,27 @@ class CameraMotionConfig:
     warmer_only = attr.ib()
     dynamic_thresh = attr.ib()
     run_classifier = attr.ib()
+    trigger_kernel = attr.ib(default=15)
+    recording_kernel = attr.ib(default=10)
+    # after idle_secs without motion detect on every idle_stride frame
+    # downscaled by idle_scale, 0 disables
+    idle_secs = attr.ib(default=0)
+    idle_stride = attr.ib(default=1)
+    idle_scale = attr.ib(default=1)
+    # frames an object must be tracked for before triggering, 0 disables
+    track_frames = attr.ib(default=0)
 
     @classmethod
     def defaults_for(cls, model):
-        if model == "lepton3.5":
+        if model == "ir":
+            return attr.evolve(
+                cls.defaults_for(None),
+                delta_thresh=25,
+                count_thresh=1,
+                frame_compare_gap=25,
+                trigger_frames=11,
+            )
+        elif model == "lepton3.5":
             return cls(
                 temp_thresh=28000,
                 delta_thresh=200,
@@ -116,6 +135,12 @@ class CameraMotionConfig:
             warmer_only=motion.get("warmer-only", default.warmer_only),
             dynamic_thresh=motion.get("dynamic-thresh", default.dynamic_thresh),
             run_classifier=motion.get("run-classifier", default.run_classifier),
+            trigger_kernel=motion.get("trigger-kernel", default.trigger_kernel),
+            recording_kernel=motion.get("recording-kernel", default.recording_kernel),
+            idle_secs=motion.get("idle-secs", default.idle_secs),
+            idle_stride=motion.get("idle-stride", default.idle_stride),
+            idle_scale=motion.get("idle-scale", default.idle_scale),
+            track_frames=motion.get("track-frames", default.track_frames),
         )
         return motion
 
@@ -126,6 +151,8 @@ class CameraMotionConfig:
 @attr.s
 class RecorderConfig:
     preview_secs = attr.ib()
+    # JPEG quality to keep the pre-roll at, 0 keeps raw frames
+    preview_quality = attr.ib()
     min_secs = attr.ib()
     max_secs = attr.ib()
     rec_window = attr.ib()
@@ -133,20 +160,56 @@ class RecorderConfig:
     disable_recordings = attr.ib()
 
     @classmethod
-    def load(cls, recorder, window):
+    def load(cls, recorder, window, model=None):
+        # the ir camera records at any time unless a window is configured
+        default_window = "" if model == "ir" else None
         return cls(
             disable_recordings=recorder.get("disable-recordings", False),
             min_secs=recorder.get("min-secs", 10),
-            max_secs=recorder.get("max-secs", 600),
+            max_secs=recorder.get("max-secs", 120 if model == "ir" else 600),
             preview_secs=recorder.get("preview-secs", 5),
+            preview_quality=recorder.get("preview-quality", 0),
             rec_window=TimeWindow(
-                RelAbsTime(window.get("start-recording"), default_offset=30 * 60),
-                RelAbsTime(window.get("stop-recording"), default_offset=30 * 60),
+                RelAbsTime(
+                    window.get("start-recording", default_window),
+                    default_offset=30 * 60,
+                ),
+                RelAbsTime(
+                    window.get("stop-recording", default_window),
+                    default_offset=30 * 60,
+                ),
             ),
             output_dir=recorder.get("output-dir", "."),
         )
 
 
+@attr.s
+class EncoderConfig:
+    # opencv or ffmpeg, the other options are only used by ffmpeg
+    backend = attr.ib()
+    codec = attr.ib()
+    preset = attr.ib()
+    crf = attr.ib()
+    keyframe_interval = attr.ib()
+    threads = attr.ib()
+
+    @classmethod
+    def load(cls, encoder):
+        backend = encoder.get("backend", "opencv")
+        if backend not in ENCODER_BACKENDS:
+            raise ValueError(
+                f"Unknown encoder backend {backend}, expected one of {ENCODER_BACKENDS}"
+            )
+        return cls(
+            backend=backend,
+            codec=encoder.get("codec", "libx264"),
+            preset=encoder.get("preset", "ultrafast"),
+            crf=encoder.get("crf", 23),
+            keyframe_interval=encoder.get("keyframe-interval"),
+            threads=encoder.get("threads"),
+        )
+
+
 @attr.s
 class DeviceConfig:
     device_id = attr.ib()
@@ -164,6 +227,7 @@ class ThermalConfig:
     device = attr.ib()
     location = attr.ib()
     throttler = attr.ib()
+    encoder = attr.ib()
 
     @classmethod
     def load_from_file(cls, filename=None, model=None):
@@ -181,10 +245,11 @@ class ThermalConfig:
             throttler=ThrottlerConfig.load(raw.get("thermal-throttler", {})),
             motion=CameraMotionConfig.load(raw.get("thermal-motion", {}), model),
             recorder=RecorderConfig.load(
-                raw.get("thermal-recorder", {}), raw.get("windows", {})
+                raw.get("thermal-recorder", {}), raw.get("windows", {}), model
             ),
             device=DeviceConfig.load(raw.get("device", {})),
             location=LocationConfig.load(raw.get("location", {})),
+            encoder=EncoderConfig.load(raw.get("encoder", {})),
         )
 
     def validate(self):
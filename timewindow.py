@@ -16,16 +16,18 @@ class TimeWindow:
     def use_sunrise_sunset(self):
         return self.start.is_relative or self.end.is_relative
 
-    def inside_window(self):
+    def inside_window(self, now=None):
+        if now is None:
+            now = datetime.now()
         if self.use_sunrise_sunset():
-            self.update_sun_times()
+            self.update_sun_times(now.date())
             if self.end.time < self.start.time:
-                return self.start.is_after() or self.end.is_before()
+                return self.start.is_after(now) or self.end.is_before(now)
         elif self.start.time == self.end.time:
             return True
-        return self.start.is_after() and self.end.is_before()
+        return self.start.is_after(now) and self.end.is_before(now)
 
-    def update_sun_times(self):
+    def update_sun_times(self, date=None):
         if not self.use_sunrise_sunset():
             return
 
@@ -33,7 +35,8 @@ class TimeWindow:
             raise ValueError(
                 "Location must be set for relative times, by calling set_location"
             )
-        date = datetime.now().date()
+        if date is None:
+            date = datetime.now().date()
         if self.last_sunrise_check is None or date > self.last_sunrise_check:
             sun_times = self.location.sun()
             self.last_sunrise_check = date
@@ -85,11 +88,15 @@ class RelAbsTime:
             else:
                 self.is_relative = True
 
-    def is_after(self):
-        return self.any_time or datetime.now().time() > self.time
+    def is_after(self, now=None):
+        if now is None:
+            now = datetime.now()
+        return self.any_time or now.time() > self.time
 
-    def is_before(self):
-        return self.any_time or datetime.now().time() < self.time
+    def is_before(self, now=None):
+        if now is None:
+            now = datetime.now()
+        return self.any_time or now.time() < self.time
 
     def parse_duration(self, time_str, default_offset=None):
         if not time_str:
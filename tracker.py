@@ -0,0 +1,136 @@
+""" Finds blobs in the eroded motion mask and follows them across frames. Blobs
+are matched to tracks with numpy distance matrices rather than a Python loop
+per pair, so a busy frame stays cheap
+"""
+import cv2
+import numpy as np
+
+# furthest a blob can be from where a track was expected, in full resolution
+# pixels
+MAX_DISTANCE = 80
+# frames a track can go unseen before it is dropped
+MAX_MISSED = 5
+# only the largest blobs are tracked, keeps a noisy frame within budget
+MAX_BLOBS = 32
+
+TRACK_DTYPE = np.dtype(
+    [
+        ("id", np.int32),
+        ("x", np.int32),
+        ("y", np.int32),
+        ("width", np.int32),
+        ("height", np.int32),
+        ("area", np.int32),
+        # pixels per frame
+        ("vx", np.float32),
+        ("vy", np.float32),
+        # frames since the track was first seen
+        ("age", np.int32),
+    ]
+)
+
+
+def set_blobs(tracks, stats):
+    tracks["x"] = stats[:, cv2.CC_STAT_LEFT]
+    tracks["y"] = stats[:, cv2.CC_STAT_TOP]
+    tracks["width"] = stats[:, cv2.CC_STAT_WIDTH]
+    tracks["height"] = stats[:, cv2.CC_STAT_HEIGHT]
+    tracks["area"] = stats[:, cv2.CC_STAT_AREA]
+
+
+class Tracker:
+    def __init__(self, max_distance=MAX_DISTANCE, max_missed=MAX_MISSED, min_area=1):
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.min_area = min_area
+        self.next_id = 1
+        self.labels = None
+        self.reset()
+
+    def reset(self):
+        # every live track, the ones seen this frame first
+        self.tracks = np.empty(0, TRACK_DTYPE)
+        self.centres = np.empty((0, 2), np.float32)
+        self.missed = np.empty(0, np.int32)
+
+    def find_blobs(self, mask, scale=1):
+        # only label the part of the mask with motion in it
+        x, y, width, height = cv2.boundingRect(mask)
+        if self.labels is None or self.labels.shape != mask.shape:
+            self.labels = np.empty(mask.shape, np.int32)
+        _, _, stats, centres = cv2.connectedComponentsWithStats(
+            mask[y : y + height, x : x + width],
+            self.labels[y : y + height, x : x + width],
+            connectivity=8,
+        )
+        # label 0 is the background
+        stats = stats[1:]
+        stats[:, cv2.CC_STAT_LEFT] += x
+        stats[:, cv2.CC_STAT_TOP] += y
+        centres = centres[1:].astype(np.float32) + (x, y)
+        if scale != 1:
+            stats[:, :4] *= scale
+            stats[:, cv2.CC_STAT_AREA] *= scale * scale
+            centres *= scale
+        keep = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] >= self.min_area)
+        if len(keep) > MAX_BLOBS:
+            largest = np.argpartition(-stats[keep, cv2.CC_STAT_AREA], MAX_BLOBS)
+            keep = np.sort(keep[largest[:MAX_BLOBS]])
+        return stats[keep], centres[keep]
+
+    def match(self, centres):
+        # returns matching track and blob indices, pairs must be each other's
+        # nearest and within max_distance of where the track was expected
+        if not len(self.tracks) or not len(centres):
+            return np.empty(0, np.intp), np.empty(0, np.intp)
+        velocity = np.stack([self.tracks["vx"], self.tracks["vy"]], axis=1)
+        expected = self.centres + velocity * (self.missed + 1)[:, None]
+        distance = np.linalg.norm(expected[:, None, :] - centres[None, :, :], axis=2)
+        nearest_blob = distance.argmin(axis=1)
+        nearest_track = distance.argmin(axis=0)
+        tracks = np.flatnonzero(nearest_track[nearest_blob] == np.arange(len(expected)))
+        blobs = nearest_blob[tracks]
+        close = distance[tracks, blobs] <= self.max_distance
+        return tracks[close], blobs[close]
+
+    def update(self, mask=None, scale=1):
+        # mask is the eroded motion image, None if there was no motion, scale
+        # is how much it was downscaled by. Returns the tracks seen this frame
+        if mask is None:
+            if not len(self.tracks):
+                return self.tracks
+            stats = np.empty((0, 5), np.int32)
+            centres = np.empty((0, 2), np.float32)
+        else:
+            stats, centres = self.find_blobs(mask, scale)
+        matched_tracks, matched_blobs = self.match(centres)
+
+        updated = self.tracks[matched_tracks]
+        set_blobs(updated, stats[matched_blobs])
+        gap = self.missed[matched_tracks] + 1
+        moved = centres[matched_blobs] - self.centres[matched_tracks]
+        velocity = moved / gap[:, None]
+        updated["vx"] = velocity[:, 0]
+        updated["vy"] = velocity[:, 1]
+        updated["age"] += gap
+
+        new_blobs = np.setdiff1d(np.arange(len(centres)), matched_blobs)
+        new = np.zeros(len(new_blobs), TRACK_DTYPE)
+        new["id"] = np.arange(self.next_id, self.next_id + len(new_blobs))
+        self.next_id += len(new_blobs)
+        set_blobs(new, stats[new_blobs])
+        new["age"] = 1
+
+        unmatched = np.setdiff1d(np.arange(len(self.tracks)), matched_tracks)
+        missed = self.missed[unmatched] + 1
+        keep = unmatched[missed <= self.max_missed]
+
+        seen = np.concatenate([updated, new])
+        self.tracks = np.concatenate([seen, self.tracks[keep]])
+        self.centres = np.concatenate(
+            [centres[matched_blobs], centres[new_blobs], self.centres[keep]]
+        )
+        self.missed = np.concatenate(
+            [np.zeros(len(seen), np.int32), self.missed[keep] + 1]
+        )
+        return seen